@@ -1,52 +1,247 @@
 import os
-from dotenv import load_dotenv, set_key
-import requests
 import json
-from langchain_core.tools import tool
-from codespaces_secrets import update_secret
+import asyncio
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.tools import tool, StructuredTool
+from codespaces_secrets import queue_secret
+from client import client, MALRequest, MAL_API_URL
+from mirror import mirror
+from shaping import shape, fit, expand_fields, compact_dumps, savings
 
-load_dotenv()
+SHAPE_RESPONSES = os.getenv("MAL_SHAPE_RESPONSES", "true").lower() == "true"
+COMPACT_RESPONSES = os.getenv("MAL_COMPACT_RESPONSES", "false").lower() == "true"
 
-ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-REFRESH_TOKEN = os.getenv("REFRESH_TOKEN")
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+# Maximum characters of tool output sent back to the model, roughly four characters per token.
+DEFAULT_OUTPUT_BUDGET = int(os.getenv("MAL_TOOL_MAX_CHARS", 6000))
+OUTPUT_BUDGETS = {
+    "read_forum_topic": 10000,
+    "anime_details_bulk": 12000,
+    "manga_details_bulk": 12000
+}
 
-@tool
-def refresh_access_token(a: str) -> str:
+def render(tool_name, response):
+    budget = None
+    if SHAPE_RESPONSES:
+        response = shape(response)
+        budget = OUTPUT_BUDGETS.get(tool_name, DEFAULT_OUTPUT_BUDGET)
+
+    # Measured in both modes and before truncation, so only the encoding itself is credited.
+    savings.record(tool_name, len(json.dumps(response)), len(compact_dumps(response)))
+
+    if not COMPACT_RESPONSES:
+        return fit(response, budget)
+
+    return fit(response, budget, dumps=compact_dumps)
+
+def mal_tool(build):
     '''
-    Refreshes the access token for MyAnimeList. Use this if you get an invalid token error when using the API, then retry the previous API call.
+    Turns a function that describes a MyAnimeList request into a tool.
+    build returns a MALRequest, the tool returns the rendered response as a str.
+    The tool gets a blocking implementation for invoke and a native async one for ainvoke, both sharing the client's connection pools and caches.
+    '''
+    annotations = {**build.__annotations__, "return": str}
+
+    @functools.wraps(build)
+    def run(*args, **kwargs):
+        return render(build.__name__, client.send(build(*args, **kwargs)))
+
+    @functools.wraps(build)
+    async def arun(*args, **kwargs):
+        return render(build.__name__, await client.asend(build(*args, **kwargs)))
+
+    run.__annotations__ = arun.__annotations__ = annotations
+
+    return StructuredTool.from_function(func=run, coroutine=arun)
+
+MAX_BULK_IDS = 25
+
+bulk_pool = ThreadPoolExecutor(max_workers=int(os.getenv("MAL_TOOL_CONCURRENCY", 4)), thread_name_prefix="mal-bulk")
+
+def details_requests(kind, ids, fields):
+    '''
+    One details request per ID, through the same cache as the single-ID tools.
+    Returns the requests and the IDs past MAX_BULK_IDS, which are not looked up.
+    '''
+    fields = expand_fields(fields, kind)
+    ids = [id.strip() for id in str(ids).replace("|", ",").split(",") if id.strip()]
+
+    requests = [
+        MALRequest("GET", f"{MAL_API_URL}/{kind}/{id}", params={"fields": fields}, cache=f"{kind}_details")
+        for id in ids[:MAX_BULK_IDS]
+    ]
+
+    return requests, ids[MAX_BULK_IDS:]
+
+def send_or_error(request):
+    try:
+        return client.send(request)
+    except Exception as e:
+        return {"error": repr(e)}
+
+def render_bulk(tool_name, requests, responses, omitted=()):
+    rows = []
+
+    for request, response in zip(requests, responses):
+        if isinstance(response, BaseException):
+            response = {"error": repr(response)}
+        if "error" in response:
+            response = {"id": request.url.rsplit("/", 1)[1], **response}
+        rows.append(shape(response))
+
+    result = {"data": rows}
+    # Said explicitly, so the model doesn't take the table for everything it asked for.
+    if omitted:
+        result["omitted"] = f"{len(omitted)} IDs over the limit of {MAX_BULK_IDS} were not looked up: {','.join(omitted)}"
+
+    return fit(result, OUTPUT_BUDGETS.get(tool_name, DEFAULT_OUTPUT_BUDGET), dumps=compact_dumps)
+
+LIST_FIELDS = {
+    "anime": "list_status,genres,media_type,num_episodes,mean",
+    "manga": "list_status,genres,media_type,num_chapters,mean"
+}
+
+def list_request(kind, user, status):
+    api_url = f"{MAL_API_URL}/users/{user}/{kind}list"
+
+    params = {
+        "status": status,
+        "fields": LIST_FIELDS[kind],
+        "limit": 1000,
+        "nsfw": "true"
+    }
+
+    return api_url, params
+
+def use_mirror(user):
+    return mirror is not None and user == "@me"
+
+def without_list_status(page):
+    # The list tools answer like MAL does without fields, which has no list_status, whether or not the mirror served them.
+    if "error" in page:
+        return page
+    return {**page, "data": [{key: value for key, value in entry.items() if key != "list_status"} for entry in page["data"]]}
+
+def user_list(kind, user, status, sort, limit, offset):
     '''
-    load_dotenv(override=True)
+    The main user's list is read from the local mirror when one is configured, everyone else's from MAL.
+    '''
+    if use_mirror(user):
+        return without_list_status(mirror.query(kind, status=status, sort=sort, limit=limit, offset=offset))
 
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
+    params = {
+        "status": status,
+        "sort": sort,
+        "limit": limit,
+        "offset": offset
+    }
 
-    api_url = "https://myanimelist.net/v1/oauth2/token"
+    return client.get(f"{MAL_API_URL}/users/{user}/{kind}list", params=params)
+
+async def auser_list(kind, user, status, sort, limit, offset):
+    if use_mirror(user):
+        return without_list_status(await asyncio.to_thread(mirror.query, kind, status=status, sort=sort, limit=limit, offset=offset))
 
     params = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "grant_type": "refresh_token",
-        "refresh_token": REFRESH_TOKEN
+        "status": status,
+        "sort": sort,
+        "limit": limit,
+        "offset": offset
     }
 
-    response = requests.post(api_url, data=params).json()
+    return await client.aget(f"{MAL_API_URL}/users/{user}/{kind}list", params=params)
+
+def list_pages(kind, user, status, genre, media_type):
+    if use_mirror(user):
+        return [mirror.query(kind, status=status, genre=genre, media_type=media_type)]
+
+    api_url, params = list_request(kind, user, status)
+    return client.paginate(api_url, params)
+
+async def alist_pages(kind, user, status, genre, media_type):
+    if use_mirror(user):
+        return [await asyncio.to_thread(mirror.query, kind, status=status, genre=genre, media_type=media_type)]
+
+    api_url, params = list_request(kind, user, status)
+    return [page async for page in client.apaginate(api_url, params)]
+
+def aggregate_list(kind, pages, genre, media_type, top_n, user):
+    '''
+    Reduces every page of a user's list to counts, a genre breakdown, the mean score and the top_n entries by score, after filtering by genre and media type.
+    Scores are only reported for @me. Other users' lists are ranked by MAL's community mean instead, since their scores must never be given out.
+    '''
+    progress = "num_episodes_watched" if kind == "anime" else "num_chapters_read"
+    entries = []
+
+    for page in pages:
+        if "error" in page:
+            return page
 
-    os.environ["ACCESS_TOKEN"] = response['access_token']
-    os.environ["REFRESH_TOKEN"] = response['refresh_token']
+        for item in page.get("data", []):
+            node = item["node"]
+            list_status = item.get("list_status") or {}
+            genres = [g["name"] for g in node.get("genres", [])]
 
-    if os.path.exists(".env"):
-        set_key(".env", "ACCESS_TOKEN", response['access_token'])
-        set_key(".env", "REFRESH_TOKEN", response['refresh_token'])
-    
+            if genre and genre.lower() not in [g.lower() for g in genres]:
+                continue
+            if media_type and node.get("media_type") != media_type:
+                continue
+
+            entries.append((node, list_status, genres))
+
+    summary = {
+        "total": len(entries),
+        "by_status": dict(Counter(list_status.get("status") for node, list_status, genres in entries)),
+        "by_genre": dict(Counter(g for node, list_status, genres in entries for g in genres).most_common(10)),
+        progress: sum(list_status.get(progress, 0) for node, list_status, genres in entries)
+    }
+
+    if user == "@me":
+        scores = [list_status["score"] for node, list_status, genres in entries if list_status.get("score")]
+        ranked = sorted(entries, key=lambda entry: entry[1].get("score", 0), reverse=True)
+
+        summary["mean_score"] = round(sum(scores) / len(scores), 2) if scores else None
+        summary["top"] = [
+            {"id": node["id"], "title": node.get("title"), "score": list_status.get("score"), "status": list_status.get("status")}
+            for node, list_status, genres in ranked[:top_n]
+        ]
+    else:
+        ranked = sorted(entries, key=lambda entry: entry[0].get("mean") or 0, reverse=True)
+
+        summary["top"] = [
+            {"id": node["id"], "title": node.get("title"), "mean": node.get("mean"), "status": list_status.get("status")}
+            for node, list_status, genres in ranked[:top_n]
+        ]
+
+    return summary
+
+def sync_secrets(access_token, refresh_token):
     if os.getenv("GH_TOKEN"):
-        update_secret("ACCESS_TOKEN", response['access_token'])
-        update_secret("REFRESH_TOKEN", response['refresh_token'])
+        queue_secret("ACCESS_TOKEN", access_token)
+        queue_secret("REFRESH_TOKEN", refresh_token)
 
-    return "Successfully refreshed the access token"
+client.on_refresh.append(sync_secrets)
 
 @tool
-def search_anime(anime_name: str) -> str:
+def refresh_access_token(a: str) -> str:
+    '''
+    Refreshes the access token for MyAnimeList. Use this if you get an invalid token error when using the API, then retry the previous API call.
+    '''
+
+    client.refresh_tokens()
+
+    return "Successfully refreshed the access token"
+
+async def arefresh_access_token(a: str) -> str:
+    await asyncio.to_thread(client.refresh_tokens)
+
+    return "Successfully refreshed the access token"
+
+refresh_access_token.coroutine = arefresh_access_token
+
+@mal_tool
+def search_anime(anime_name: str) -> MALRequest:
     '''
     Takes a string and searches MyAnimeList for the anime. 
     The result will be a JSON table of titles and IDs. 
@@ -54,24 +249,16 @@ def search_anime(anime_name: str) -> str:
     Use this when you know the name of an anime but not the ID, or searching for an anime by name.
     If the search returns 'invalid q', try using simpler search terms to widen the search.
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = "https://api.myanimelist.net/v2/anime"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/anime"
 
     params = {
         "q": anime_name
     } 
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params, cache="search_anime")
 
-@tool
-def anime_details(id: int, fields: str) -> str:
+@mal_tool
+def anime_details(id: int, fields: str) -> MALRequest:
     '''
     Provides details on the anime from MyAnimeList using an integer ID. 
     PRIMARY AUTHENTICATED USER ONLY (@me)!!!: my_list_status field, if and only if it is on the user's list, contains watching status, individual score, episodes watched, if they're rewatching, and time updated. All values required. This field will only ever get you MY details, so never ever use it to find anyone else's information.
@@ -79,26 +266,37 @@ def anime_details(id: int, fields: str) -> str:
     English titles are located in the alternative_titled field.
     fields: comma separated list of fields to return, without spaces between commas.
     Possible fields are: id,title,main_picture,alternative_titles,start_date,end_date,synopsis,mean,rank,popularity,num_list_users,num_scoring_users,nsfw,created_at,updated_at,media_type,status,genres,my_list_status,num_episodes,start_season,broadcast,source,average_episode_duration,rating,pictures,background,related_anime,related_manga,recommendations,studios,statistics
+    Presets can be used in place of fields: summary (titles, dates, type, status, episodes, genres, score, rank, synopsis), scoring (score, rank, popularity, user counts, statistics), relations (related anime and manga, recommendations). Example: summary,my_list_status
     '''
+    api_url = f"{MAL_API_URL}/anime/{id}"
 
-    load_dotenv(override=True)
+    params = {
+        "fields": expand_fields(fields, "anime")
+    }
 
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
+    return MALRequest("GET", api_url, params=params, cache="anime_details")
 
-    api_url = f"https://api.myanimelist.net/v2/anime/{id}"
+@tool
+def anime_details_bulk(ids: str, fields: str) -> str:
+    '''
+    Provides details on several anime at once, as a table with one row per anime. Use this instead of calling anime_details repeatedly, for example on every ID returned by search_anime or ranked_anime.
+    ids: comma separated list of integer IDs, at most 25.
+    fields: comma separated list of fields to return, without spaces between commas. Takes the same fields and presets as anime_details.
+    '''
 
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    requests, omitted = details_requests("anime", ids, fields)
 
-    params = {
-        "fields": fields
-    }
+    return render_bulk("anime_details_bulk", requests, bulk_pool.map(send_or_error, requests), omitted)
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+async def aanime_details_bulk(ids: str, fields: str) -> str:
+    requests, omitted = details_requests("anime", ids, fields)
 
-@tool
-def ranked_anime(limit: int, offset: int, field: str) -> str:
+    return render_bulk("anime_details_bulk", requests, await asyncio.gather(*map(client.asend, requests), return_exceptions=True), omitted)
+
+anime_details_bulk.coroutine = aanime_details_bulk
+
+@mal_tool
+def ranked_anime(limit: int, offset: int, field: str) -> MALRequest:
     '''
     Searches anime by ranking.
     limit: Number of results to return. Make this as small as possible to get the necessary information.
@@ -108,16 +306,7 @@ def ranked_anime(limit: int, offset: int, field: str) -> str:
 
     Example: limit=1 offset=4 field=all will get the 5th top anime series.
     '''
-
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/anime/ranking"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/anime/ranking"
 
     params = {
         "ranking_type": field,
@@ -125,10 +314,10 @@ def ranked_anime(limit: int, offset: int, field: str) -> str:
         "offset": offset
     }
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params, cache="ranked_anime")
 
-@tool
-def seasonal_anime(year: int, season: str, sort: str, limit: int, offset: int) -> str:
+@mal_tool
+def seasonal_anime(year: int, season: str, sort: str, limit: int, offset: int) -> MALRequest:
     '''
     Gets seasonal anime from MyAnimelist.
     year: example: 2025
@@ -137,23 +326,14 @@ def seasonal_anime(year: int, season: str, sort: str, limit: int, offset: int) -
     limit: number of anime to return. Keep as low as possible.
     offset: number away from the top. 0 will be the top rated or top users.
     '''
-
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/anime/season/{year}/{season}"
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
-
+    api_url = f"{MAL_API_URL}/anime/season/{year}/{season}"
     params = {
         "ranking_type": sort,
         "limit": limit,
         "offset": offset
     }
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params, cache="seasonal_anime")
 
 @tool
 def get_user_anime_list(user: str, status: str | None, sort: str, limit: int, offset: int) -> str:
@@ -165,41 +345,47 @@ def get_user_anime_list(user: str, status: str | None, sort: str, limit: int, of
     limit: Number of results to return. Keep this as low as possible.
     offset: number away from the top. 0 will be the top of the list.
     '''
-    load_dotenv(override=True)
 
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
+    return render("get_user_anime_list", user_list("anime", user, status, sort, limit, offset))
 
-    api_url = f"https://api.myanimelist.net/v2/users/{user}/animelist"
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+async def aget_user_anime_list(user: str, status: str | None, sort: str, limit: int, offset: int) -> str:
+    return render("get_user_anime_list", await auser_list("anime", user, status, sort, limit, offset))
 
-    params = {
-        "status": status,
-        "sort": sort,
-        "limit": limit,
-        "offset": offset
-    }
-
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+get_user_anime_list.coroutine = aget_user_anime_list
 
 @tool
-def update_anime_list(id: int, status: str, score: int, is_rewatching: str, num_watched_episodes: int, num_times_rewatched: int) -> str:
+def anime_list_summary(user: str, status: str | None, genre: str | None, media_type: str | None, top_n: int) -> str:
+    '''
+    Reads a user's entire anime list, every page of it, and answers aggregate questions in one call: how many entries there are by status, the most common genres, the mean score, episodes watched, and the top entries by score.
+    Use this instead of paging through get_user_anime_list, e.g. for "how many action shows have I completed" or "what are my 10 favourite movies".
+    Scores and the mean score are only given for @me. For any other user the top entries are ranked by MyAnimeList's overall mean instead, their own scores can never be found.
+    user: Use @me for the main user's list
+    status: None for all, or watching, completed, on_hold, dropped, plan_to_watch
+    genre: None, or a genre name to filter by, e.g. Action, Shounen
+    media_type: None, or tv, movie, ova, ona, special, music to filter by
+    top_n: number of top scored entries to return
+    '''
+
+    pages = list_pages("anime", user, status, genre, media_type)
+
+    return render("anime_list_summary", aggregate_list("anime", pages, genre, media_type, top_n, user))
+
+async def aanime_list_summary(user: str, status: str | None, genre: str | None, media_type: str | None, top_n: int) -> str:
+    pages = await alist_pages("anime", user, status, genre, media_type)
+
+    return render("anime_list_summary", aggregate_list("anime", pages, genre, media_type, top_n, user))
+
+anime_list_summary.coroutine = aanime_list_summary
+
+@mal_tool
+def update_anime_list(id: int, status: str, score: int, is_rewatching: str, num_watched_episodes: int, num_times_rewatched: int) -> MALRequest:
     '''
     Updates a user's anime list from MyAnimelist. Make sure the fields not asked to be updated remain the same. Current status can be found using the anime_details tool.
     status: watching, completed, on_hold, dropped, plan_to_watch
     score: 0-10
     is_rewatching: true or false. lowercase.
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/anime/{id}/my_list_status"
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
-
+    api_url = f"{MAL_API_URL}/anime/{id}/my_list_status"
     params = {
         "status": status,
         "score": score,
@@ -208,53 +394,36 @@ def update_anime_list(id: int, status: str, score: int, is_rewatching: str, num_
         "num_times_rewatched": num_times_rewatched
     }
 
-    return json.dumps(requests.put(api_url, headers=headers, data=params).json())
+    return MALRequest("PUT", api_url, data=params)
 
-@tool
-def delete_anime_from_list(id: int) -> str:
+@mal_tool
+def delete_anime_from_list(id: int) -> MALRequest:
     '''
     Deletes an entry from the user's anime list. The only parameter is the anime id. The response will either be 200 or 404 indicating whether or not the item was on the list before deletion. 404 means it was never on the user's list.
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/anime/{id}/my_list_status"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/anime/{id}/my_list_status"
 
     params = {
         "anime_id": id
     }
 
-    return json.dumps(requests.delete(api_url, headers=headers, data=params).json())
+    return MALRequest("DELETE", api_url, data=params)
 
-@tool
+@mal_tool
 def user_details(fields):
     '''
     Returns information about the user, as well as statistics such as counts of certain lists. The id should always be @me. It is not possible to get this information about other users.
     fields should be a comma separated list with no spaces. Valid fields are: id, name, picture, gender, birthday, location, joined_at, anime_statistics, time_zone, is_supporter
     '''
-
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/users/@me"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/users/@me"
 
     params = {
         "fields": fields
     }
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params)
 
-@tool
+@mal_tool
 def search_manga(manga_name):
     '''
     Takes a string and searches MyAnimeList for the manga. 
@@ -263,50 +432,55 @@ def search_manga(manga_name):
     Use this when you know the name of a manga but not the ID, or searching for a manga by name.
     If the search returns 'invalid q', try using simpler search terms to widen the search.
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = "https://api.myanimelist.net/v2/manga"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/manga"
 
     params = {
         "q": manga_name
     } 
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params, cache="search_manga")
 
-@tool
+@mal_tool
 def manga_details(values):
     '''
     Provides details on the manga from MyAnimeList using an integer ID. FOR THE AUTHENTICATED USER ONLY!!!!: my_list_status field, if and only if it is on the user's list, contains reading status, individual score, chapters read, if they're rereading, and time updated. This field will only ever get you MY details, so never ever use it to find anyone else's information.
     Use search_manga to find this ID.
     There should be 2 inputs separated by a |. One is the id in numerical form. This is followed by a comma separated list of fields to return, without spaces between commas.
     Possible fields are: id,title,main_picture,alternative_titles,start_date,end_date,synopsis,mean,rank,popularity,num_list_users,num_scoring_users,nsfw,genres,created_at,updated_at,media_type,status,genres,my_list_status,num_chapters,authors,pictures,background,related_anime,related_manga,related_manga,recommendations,serialization
+    Presets can be used in place of fields: summary (titles, dates, type, status, volumes, chapters, authors, genres, score, rank, synopsis), scoring (score, rank, popularity, user counts), relations (related anime and manga, recommendations). Example: 2|summary,my_list_status
     '''
-
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
     id, fields = values.split('|')
 
-    api_url = f"https://api.myanimelist.net/v2/manga/{id}"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/manga/{id}"
 
     params = {
-        "fields": fields
+        "fields": expand_fields(fields, "manga")
     }
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params, cache="manga_details")
 
 @tool
+def manga_details_bulk(values):
+    '''
+    Provides details on several manga at once, as a table with one row per manga. Use this instead of calling manga_details repeatedly, for example on every ID returned by search_manga or ranked_manga.
+    There should be 2 inputs separated by a |. The first is a comma separated list of numerical IDs, at most 25. This is followed by a comma separated list of fields to return, without spaces between commas. Takes the same fields and presets as manga_details.
+    Example: 2,13,21|summary
+    '''
+
+    ids, fields = values.split('|')
+    requests, omitted = details_requests("manga", ids, fields)
+
+    return render_bulk("manga_details_bulk", requests, bulk_pool.map(send_or_error, requests), omitted)
+
+async def amanga_details_bulk(values):
+    ids, fields = values.split('|')
+    requests, omitted = details_requests("manga", ids, fields)
+
+    return render_bulk("manga_details_bulk", requests, await asyncio.gather(*map(client.asend, requests), return_exceptions=True), omitted)
+
+manga_details_bulk.coroutine = amanga_details_bulk
+
+@mal_tool
 def ranked_manga(values):
     '''
     Searches manga by ranking. There should be 3 inputs separated by a |.
@@ -317,18 +491,9 @@ def ranked_manga(values):
 
     Example: 1|4|all will get the 5th top manga.
     '''
-
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
     limit, offset, field = values.split('|')
 
-    api_url = f"https://api.myanimelist.net/v2/manga/ranking"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/manga/ranking"
 
     params = {
         "ranking_type": field,
@@ -336,7 +501,14 @@ def ranked_manga(values):
         "offset": offset
     }
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params, cache="ranked_manga")
+
+def user_list_args(values):
+    user, status, sort, limit, offset = values.split("|")
+    if status == "all":
+        status = None
+
+    return user, status, sort, limit, offset
 
 @tool
 def get_user_manga_list(values):
@@ -348,29 +520,51 @@ def get_user_manga_list(values):
     Limit: Number of results to return. Keep this as low as possible.
     Offset: integer representing the number away from the top. 0 will be the top of the list.
     '''
-    load_dotenv(override=True)
 
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
+    return render("get_user_manga_list", user_list("manga", *user_list_args(values)))
 
-    user, status, sort, limit, offset = values.split("|")
-    if status == "all":
-        status = None
+async def aget_user_manga_list(values):
+    return render("get_user_manga_list", await auser_list("manga", *user_list_args(values)))
 
-    api_url = f"https://api.myanimelist.net/v2/users/{user}/mangalist"
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+get_user_manga_list.coroutine = aget_user_manga_list
 
-    params = {
-        "status": status,
-        "sort": sort,
-        "limit": limit,
-        "offset": offset
-    }
+def manga_list_summary_args(values):
+    user, status, genre, top_n = values.split("|")
+
+    if status in ("all", "None"):
+        status = None
+    if genre == "None":
+        genre = None
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return user, status, genre, int(top_n)
 
 @tool
+def manga_list_summary(values):
+    '''
+    Reads a user's entire manga list, every page of it, and answers aggregate questions in one call: how many entries there are by status, the most common genres, the mean score, chapters read, and the top entries by score.
+    Use this instead of paging through get_user_manga_list. Values should be given separated by a |. All values required.
+    Scores and the mean score are only given for @me. For any other user the top entries are ranked by MyAnimeList's overall mean instead, their own scores can never be found.
+    Username: Use @me for the main user's list
+    Status: all, reading, completed, on_hold, dropped, plan_to_read
+    Genre: a genre name to filter by, or None
+    Top: number of top scored entries to return
+    Example: @me|completed|Romance|5
+    '''
+
+    user, status, genre, top_n = manga_list_summary_args(values)
+    pages = list_pages("manga", user, status, genre, None)
+
+    return render("manga_list_summary", aggregate_list("manga", pages, genre, None, top_n, user))
+
+async def amanga_list_summary(values):
+    user, status, genre, top_n = manga_list_summary_args(values)
+    pages = await alist_pages("manga", user, status, genre, None)
+
+    return render("manga_list_summary", aggregate_list("manga", pages, genre, None, top_n, user))
+
+manga_list_summary.coroutine = amanga_list_summary
+
+@mal_tool
 def update_manga_list(values):
     '''
     Updates a user's manga list from MyAnimelist. Make sure the fields not asked to be updated remain the same. Current status can be found using the manga_details tool. Values should be given separated by a |. All values required.
@@ -382,17 +576,9 @@ def update_manga_list(values):
     num_chapters_read: integer number of chapters read.
     num_times_reread: integer number of times the entry has been reread
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
     id, status, is_rereading, score, num_volumes_read, num_chapters_read, num_times_reread = values.split("|")
 
-    api_url = f"https://api.myanimelist.net/v2/manga/{id}/my_list_status"
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
-
+    api_url = f"{MAL_API_URL}/manga/{id}/my_list_status"
     params = {
         "status": status,
         "score": score,
@@ -402,49 +588,33 @@ def update_manga_list(values):
         "num_times_reread": num_times_reread
     }
 
-    return json.dumps(requests.put(api_url, headers=headers, data=params).json())
+    return MALRequest("PUT", api_url, data=params)
 
-@tool
+@mal_tool
 def delete_manga_from_list(id):
     '''
     Deletes an entry from the user's manga list. The only parameter is the manga id. The response will either be 200 or 404 indicating whether or not the item was on the list before deletion. 404 means it was never on the user's list.
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/manga/{id}/my_list_status"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/manga/{id}/my_list_status"
 
     params = {
         "manga_id": id
     }
 
-    return json.dumps(requests.delete(api_url, headers=headers, data=params).json())
+    return MALRequest("DELETE", api_url, data=params)
 
-@tool
+@mal_tool
 def get_forum_boards(values):
     '''
     Gets the available forum boards and subboards from MyAnimeList. Action Input should be None.
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/forum/boards"
+    api_url = f"{MAL_API_URL}/forum/boards"
 
     values = None
 
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
-
-    return json.dumps(requests.get(api_url, headers=headers).json())
+    return MALRequest("GET", api_url, cache="get_forum_boards")
 
-@tool
+@mal_tool
 def get_forum_topics(values):
     '''
     Gets the topics within a forum board and/or subboard. All values are required and should be separated by a |.
@@ -452,11 +622,7 @@ def get_forum_topics(values):
     subboard_id: Optional, recommended if available. None if none.
     query: Optional, recommended search query. None if none.
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/forum/topics"
+    api_url = f"{MAL_API_URL}/forum/topics"
 
     board_id, subboard_id, q = values.split('|')
 
@@ -467,10 +633,6 @@ def get_forum_topics(values):
     if q == "None":
         q = None
 
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
-
     params = {
         "board_id": board_id,
         "subboard_id": subboard_id,
@@ -478,28 +640,23 @@ def get_forum_topics(values):
         "limit": 10
     }
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params)
 
-@tool
+@mal_tool
 def read_forum_topic(id):
     '''
     Reads the forum topic from the given topic id, acquired from get_forum_topics.
     '''
-    load_dotenv(override=True)
-
-    ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-
-    api_url = f"https://api.myanimelist.net/v2/forum/topic/{id}"
-
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    api_url = f"{MAL_API_URL}/forum/topic/{id}"
 
     params = {
         "limit": 10
     }
 
-    return json.dumps(requests.get(api_url, headers=headers, params=params).json())
+    return MALRequest("GET", api_url, params=params)
+
+# Tools that change state on MyAnimeList. Calls to these must run in the order the model made them.
+write_tools = {"refresh_access_token", "update_anime_list", "delete_anime_from_list", "update_manga_list", "delete_manga_from_list"}
 
 system_tools = [refresh_access_token, user_details]
-anime_tools = [search_anime, anime_details, ranked_anime, seasonal_anime, get_user_anime_list, update_anime_list, delete_anime_from_list]
\ No newline at end of file
+anime_tools = [search_anime, anime_details, anime_details_bulk, ranked_anime, seasonal_anime, get_user_anime_list, anime_list_summary, update_anime_list, delete_anime_from_list]
\ No newline at end of file
@@ -0,0 +1,85 @@
+import time
+import uuid
+import threading
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+class ScriptedChatModel(BaseChatModel):
+    '''
+    Chat model that replays a fixed script instead of calling a provider.
+    Each step is either the text to answer with or {"content": ..., "tool_calls": [{"name": ..., "args": {...}}]}. Once the script runs out the last step is repeated.
+    latency is the time to first token and token_latency the delay between streamed tokens. Token counts are estimated at four characters each.
+    '''
+
+    script: list
+    latency: float = 0.0
+    token_latency: float = 0.0
+
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _position: int = PrivateAttr(default=0)
+    _usage: dict = PrivateAttr(default_factory=lambda: {"calls": 0, "tool_calls": 0, "input_tokens": 0, "output_tokens": 0})
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    @property
+    def usage(self):
+        with self._lock:
+            return dict(self._usage)
+
+    def bind_tools(self, tools, **kwargs):
+        # Tool calls come from the script, so the tool schemas aren't needed.
+        return self
+
+    def next_message(self, messages):
+        with self._lock:
+            step = self.script[min(self._position, len(self.script) - 1)]
+            self._position += 1
+
+            if isinstance(step, str):
+                step = {"content": step}
+
+            tool_calls = [
+                {"name": call["name"], "args": call.get("args", {}), "id": call.get("id") or f"call_{uuid.uuid4().hex[:12]}"}
+                for call in step.get("tool_calls", [])
+            ]
+            content = step.get("content", "")
+
+            input_tokens = sum(estimate_tokens(str(message.content)) for message in messages)
+            output_tokens = estimate_tokens(content) + sum(estimate_tokens(str(call["args"])) for call in tool_calls)
+
+            self._usage["calls"] += 1
+            # ReAct agents call tools with an "Action:" line rather than tool_calls.
+            self._usage["tool_calls"] += len(tool_calls) + sum(line.startswith("Action:") for line in content.splitlines())
+            self._usage["input_tokens"] += input_tokens
+            self._usage["output_tokens"] += output_tokens
+
+        usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+        return AIMessage(content=content, tool_calls=tool_calls, usage_metadata=usage_metadata)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.next_message(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        message = self.next_message(messages)
+
+        words = message.content.split(" ")
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(self.token_latency)
+
+            text = word if index == len(words) - 1 else word + " "
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=message.usage_metadata))
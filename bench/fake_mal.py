@@ -0,0 +1,299 @@
+import os
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures.json")
+
+# (method, path pattern, endpoint name)
+ROUTES = [
+    ("POST", r"/v1/oauth2/token", "token"),
+    ("GET", r"/v2/users/@me", "user_details"),
+    ("GET", r"/v2/users/([^/]+)/(anime|manga)list", "user_list"),
+    ("GET", r"/v2/(anime|manga)/ranking", "ranking"),
+    ("GET", r"/v2/anime/season/(\d+)/(\w+)", "seasonal_anime"),
+    ("GET", r"/v2/(anime|manga)", "search"),
+    ("GET", r"/v2/(anime|manga)/(\d+)", "details"),
+    ("PUT", r"/v2/(anime|manga)/(\d+)/my_list_status", "update_list"),
+    ("DELETE", r"/v2/(anime|manga)/(\d+)/my_list_status", "delete_from_list"),
+    ("GET", r"/v2/forum/boards", "forum_boards"),
+    ("GET", r"/v2/forum/topics", "forum_topics"),
+    ("GET", r"/v2/forum/topic/(\d+)", "forum_topic")
+]
+
+ALWAYS_INCLUDED = {"id", "title", "main_picture"}
+
+class FakeMAL:
+    '''
+    Stand-in for the MyAnimeList API, serving the recorded fixtures in fixtures.json for every endpoint api.py uses.
+    latency is added to every response. p401 and p429 are the chances a request is answered with a 401 (the access token is also revoked, so the client has to refresh it) or a 429 with Retry-After.
+    Requests are counted per endpoint so a benchmark can report MAL calls per query.
+    '''
+
+    def __init__(self, fixtures=FIXTURES, latency=0.0, p401=0.0, p429=0.0, retry_after=1, seed=0):
+        with open(fixtures, encoding="utf-8") as file:
+            self.fixtures = json.load(file)
+
+        self.latency = latency
+        self.p401 = p401
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.generation = 0
+        self.access_token = "fake-access-0"
+        self.refresh_token = "fake-refresh"
+        self.lists = {kind: {item["node"]["id"]: dict(item["list_status"]) for item in self.fixtures[f"{kind}list"]} for kind in ("anime", "manga")}
+        self.server = None
+        self.base_url = None
+
+    def start(self, host="127.0.0.1", port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                fake.handle(self, "GET")
+
+            def do_POST(self):
+                fake.handle(self, "POST")
+
+            def do_PUT(self):
+                fake.handle(self, "PUT")
+
+            def do_DELETE(self):
+                fake.handle(self, "DELETE")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://{host}:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name="fake-mal", daemon=True).start()
+
+        return self.base_url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def total(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+
+    def handle(self, request, method):
+        url = urlsplit(request.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        length = int(request.headers.get("Content-Length") or 0)
+        form = {name: values[-1] for name, values in parse_qs(request.rfile.read(length).decode()).items()} if length else {}
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        for route_method, pattern, endpoint in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if match and route_method == method:
+                break
+        else:
+            return self.respond(request, 404, {"error": "not_found"})
+
+        with self.lock:
+            self.requests[endpoint] += 1
+            roll = self.random.random()
+
+        if endpoint == "token":
+            return self.respond(request, 200, self.issue_token())
+
+        if request.headers.get("Authorization") != f"Bearer {self.access_token}":
+            return self.respond(request, 401, {"error": "invalid_token"})
+        if roll < self.p401:
+            self.revoke_token()
+            return self.respond(request, 401, {"error": "invalid_token"})
+        if roll < self.p401 + self.p429:
+            return self.respond(request, 429, {"error": "too_many_requests"}, {"Retry-After": str(self.retry_after)})
+
+        status, body = getattr(self, endpoint)(*match.groups(), query=query, form=form)
+        self.respond(request, status, body)
+
+    def respond(self, request, status, body, headers=None):
+        payload = json.dumps(body).encode()
+
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def issue_token(self):
+        with self.lock:
+            self.generation += 1
+            self.access_token = f"fake-access-{self.generation}"
+
+        return {
+            "token_type": "Bearer",
+            "expires_in": 2678400,
+            "access_token": self.access_token,
+            "refresh_token": self.refresh_token
+        }
+
+    def revoke_token(self):
+        with self.lock:
+            self.access_token = f"fake-revoked-{self.generation}"
+
+    def entry(self, kind, id, fields=None):
+        '''
+        The fixture for an id, limited to the requested fields. Unknown ids get a generic entry so any id resolves.
+        '''
+        entry = next((item for item in self.fixtures[kind] if item["id"] == int(id)), None)
+        if entry is None:
+            entry = {"id": int(id), "title": f"{kind.title()} {id}", "mean": 7.0, "media_type": "tv" if kind == "anime" else "manga", "genres": []}
+
+        if fields is None:
+            return dict(entry)
+
+        wanted = ALWAYS_INCLUDED | {field.strip() for field in fields.split(",")}
+        entry = {name: value for name, value in entry.items() if name in wanted}
+
+        if "my_list_status" in wanted and int(id) in self.lists[kind]:
+            entry["my_list_status"] = self.lists[kind][int(id)]
+
+        return entry
+
+    def page(self, path, items, query):
+        limit = int(query.get("limit") or 10)
+        offset = int(query.get("offset") or 0)
+        paging = {}
+
+        if offset + limit < len(items):
+            paging["next"] = f"{self.base_url}{path}?" + urlencode({**query, "offset": offset + limit})
+        if offset > 0:
+            paging["previous"] = f"{self.base_url}{path}?" + urlencode({**query, "offset": max(0, offset - limit)})
+
+        return {"data": items[offset:offset + limit], "paging": paging}
+
+    def user_details(self, query, form):
+        return 200, self.fixtures["user"]
+
+    def user_list(self, user, kind, query, form):
+        if user != "@me":
+            return 200, {"data": [], "paging": {}}
+
+        status = query.get("status")
+        items = [
+            {"node": self.entry(kind, id, query.get("fields", "")), "list_status": list_status}
+            for id, list_status in self.lists[kind].items()
+            if status is None or list_status["status"] == status
+        ]
+
+        sort = query.get("sort")
+        if sort == "list_score":
+            items.sort(key=lambda item: item["list_status"]["score"], reverse=True)
+        elif sort == "list_updated_at":
+            items.sort(key=lambda item: item["list_status"]["updated_at"], reverse=True)
+        elif sort in ("anime_title", "manga_title"):
+            items.sort(key=lambda item: item["node"]["title"])
+
+        # List statuses are only returned when asked for, like the real API.
+        if "list_status" not in query.get("fields", ""):
+            items = [{"node": item["node"]} for item in items]
+
+        return 200, self.page(f"/v2/users/{user}/{kind}list", items, query)
+
+    def ranking(self, kind, query, form):
+        entries = sorted(self.fixtures[kind], key=lambda entry: entry.get("rank") or 0)
+        items = [{"node": self.entry(kind, entry["id"], query.get("fields", "")), "ranking": {"rank": entry.get("rank")}} for entry in entries]
+
+        return 200, self.page(f"/v2/{kind}/ranking", items, query)
+
+    def seasonal_anime(self, year, season, query, form):
+        items = [
+            {"node": self.entry("anime", entry["id"], query.get("fields", ""))}
+            for entry in self.fixtures["anime"]
+            if entry.get("start_season") == {"year": int(year), "season": season}
+        ]
+
+        return 200, {**self.page(f"/v2/anime/season/{year}/{season}", items, query), "season": {"year": int(year), "season": season}}
+
+    def search(self, kind, query, form):
+        q = (query.get("q") or "").lower()
+        if len(q) < 3:
+            return 400, {"message": "invalid q", "error": "bad_request"}
+
+        items = [
+            {"node": self.entry(kind, entry["id"], query.get("fields", ""))}
+            for entry in self.fixtures[kind]
+            if q in json.dumps(entry.get("alternative_titles", {})).lower() or q in entry["title"].lower()
+        ]
+
+        return 200, self.page(f"/v2/{kind}", items, query)
+
+    def details(self, kind, id, query, form):
+        return 200, self.entry(kind, id, query.get("fields"))
+
+    def update_list(self, kind, id, query, form):
+        with self.lock:
+            list_status = self.lists[kind].setdefault(int(id), {"status": None, "score": 0})
+
+            for name, value in form.items():
+                list_status[name] = int(value) if value.isdigit() else value
+            list_status["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime())
+
+            return 200, dict(list_status)
+
+    def delete_from_list(self, kind, id, query, form):
+        with self.lock:
+            if self.lists[kind].pop(int(id), None) is None:
+                return 404, {"error": "not_found"}
+            return 200, []
+
+    def forum_boards(self, query, form):
+        return 200, self.fixtures["forum_boards"]
+
+    def forum_topics(self, query, form):
+        q = (query.get("q") or "").lower()
+        items = [topic for topic in self.fixtures["forum_topics"] if q in topic["title"].lower()]
+
+        return 200, self.page("/v2/forum/topics", items, query)
+
+    def forum_topic(self, id, query, form):
+        topic = self.fixtures["forum_topic"]
+
+        return 200, {"data": {**topic, "posts": topic["posts"][:int(query.get("limit") or 100)]}, "paging": {}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake MyAnimeList API from recorded fixtures.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--p401", type=float, default=0.0, help="chance a request gets a 401 and the token is revoked")
+    parser.add_argument("--p429", type=float, default=0.0, help="chance a request gets a 429")
+    args = parser.parse_args()
+
+    fake = FakeMAL(latency=args.latency, p401=args.p401, p429=args.p429)
+    base_url = fake.start(port=args.port)
+
+    print(f"Fake MAL listening on {base_url}")
+    print(f"MAL_API_URL={base_url}/v2")
+    print(f"MAL_TOKEN_URL={base_url}/v1/oauth2/token")
+    print(f"ACCESS_TOKEN={fake.access_token}")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,244 @@
+'''
+End-to-end latency benchmark for the agent pipelines, fully offline.
+
+Starts the fake MAL server, points the client at it, replaces the chat model with a scripted one and runs every query in corpus.json
+through brain.MALAI (the ReAct agent) and/or graph.py, reporting p50/p95 latency, tool calls, tokens and MAL requests per query.
+
+    python -m bench.run --pipeline both --runs 5 --mal-latency 0.05 --llm-latency 0.2
+'''
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+from bench.fake_mal import FakeMAL
+
+CORPUS = os.path.join(os.path.dirname(__file__), "corpus.json")
+
+def percentile(values, percent):
+    '''
+    Nearest-rank percentile.
+    '''
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+def configure(fake, args):
+    '''
+    Points everything at the fake server before the app modules are imported, since they read their settings at import time.
+    '''
+    env_file = tempfile.NamedTemporaryFile("w", suffix=".env", delete=False)
+    env_file.close()
+
+    os.environ.update({
+        "MAL_API_URL": f"{fake.base_url}/v2",
+        "MAL_TOKEN_URL": f"{fake.base_url}/v1/oauth2/token",
+        "MAL_ENV_FILE": env_file.name,
+        "MAL_WATCH_ENV": "false",
+        "ACCESS_TOKEN": fake.access_token,
+        "REFRESH_TOKEN": fake.refresh_token,
+        "CLIENT_ID": "benchmark",
+        "CLIENT_SECRET": "benchmark",
+        "MAL_RETRY_BACKOFF": "0.05",
+        # graph.py builds an Azure model at import. It is replaced before use, but needs settings to be constructed.
+        "AZURE_OPENAI_ENDPOINT": os.getenv("AZURE_OPENAI_ENDPOINT") or "http://localhost",
+        "AZURE_OPENAI_KEY": os.getenv("AZURE_OPENAI_KEY") or "benchmark",
+        "OPENAI_API_VERSION": "2024-02-01"
+    })
+
+    # Nothing should leave the machine, and every run should start from the same state.
+    for name in ("MAL_CACHE_DB", "MAL_MIRROR_DB", "MAL_RATE_LIMIT_DB", "GH_TOKEN", "LANGFUSE_SECRET_KEY", "LANGFUSE_PUBLIC_KEY", "LANGSMITH_TRACING"):
+        os.environ.pop(name, None)
+
+    if args.no_rate_limit:
+        os.environ["MAL_RATE_LIMIT"] = "1000"
+        os.environ["MAL_RATE_BURST"] = "1000"
+
+def clear_caches():
+    from client import client
+
+    for store in client.caches.values():
+        store.clear()
+
+def scripted_model(script, args):
+    from bench.fake_llm import ScriptedChatModel
+
+    return ScriptedChatModel(script=script, latency=args.llm_latency, token_latency=args.token_latency)
+
+async def run_react(entry, args):
+    import brain
+
+    model = scripted_model(entry["script"], args)
+    brain.build_llm = lambda provider, name, hf_model: model
+    brain.executors.discard(("Benchmark", entry["id"]))
+
+    started = time.perf_counter()
+    first = None
+    output = None
+
+    async for output in brain.MALAI(entry["query"], "Benchmark", entry["id"], None):
+        if first is None:
+            first = time.perf_counter() - started
+
+    return time.perf_counter() - started, first, model.usage, output
+
+async def run_graph(entry, args):
+    import graph
+    from cassette import record_model
+
+    model = scripted_model(entry["script"], args)
+    graph.llm = record_model(model)
+
+    started = time.perf_counter()
+    result = await asyncio.to_thread(graph.graph.invoke, {"messages": [{"role": "user", "content": entry["query"]}]})
+
+    return time.perf_counter() - started, None, model.usage, result["messages"][-1].content
+
+PIPELINES = {
+    "react": run_react,
+    "graph": run_graph
+}
+
+async def benchmark(fake, pipeline, corpus, args):
+    results = []
+
+    for entry in corpus:
+        if pipeline not in entry:
+            continue
+
+        run = {"id": entry["id"], **entry[pipeline]}
+
+        for attempt in range(args.warmup + args.runs):
+            if not args.warm:
+                clear_caches()
+            fake.reset()
+
+            latency, first, usage, output = await PIPELINES[pipeline](run, args)
+
+            if attempt < args.warmup:
+                continue
+
+            results.append({
+                "pipeline": pipeline,
+                "query": entry["id"],
+                "latency": latency,
+                "first_output": first,
+                "llm_calls": usage["calls"],
+                "tool_calls": usage["tool_calls"],
+                "tokens": usage["input_tokens"] + usage["output_tokens"],
+                "mal_requests": fake.total(),
+                "output": output
+            })
+
+    return results
+
+def summarize(results):
+    summary = {}
+
+    for pipeline in sorted({result["pipeline"] for result in results}):
+        runs = [result for result in results if result["pipeline"] == pipeline]
+        latencies = [result["latency"] for result in runs]
+        first = [result["first_output"] for result in runs if result["first_output"] is not None]
+
+        summary[pipeline] = {
+            "runs": len(runs),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p50_first_output_ms": round(percentile(first, 50) * 1000, 1) if first else None,
+            "tool_calls_per_query": round(statistics.mean(result["tool_calls"] for result in runs), 2),
+            "llm_calls_per_query": round(statistics.mean(result["llm_calls"] for result in runs), 2),
+            "tokens_per_query": round(statistics.mean(result["tokens"] for result in runs), 1),
+            "mal_requests_per_query": round(statistics.mean(result["mal_requests"] for result in runs), 2)
+        }
+
+    return summary
+
+def print_table(summary):
+    columns = ["runs", "p50_ms", "p95_ms", "p50_first_output_ms", "tool_calls_per_query", "llm_calls_per_query", "tokens_per_query", "mal_requests_per_query"]
+
+    print("pipeline".ljust(10) + "".join(column.rjust(24) for column in columns))
+    for pipeline, row in summary.items():
+        print(pipeline.ljust(10) + "".join(str(row[column] if row[column] is not None else "-").rjust(24) for column in columns))
+
+def check_baseline(summary, baseline_path, tolerance):
+    '''
+    Compares against a previous --output file and returns the metrics that got worse by more than tolerance (a fraction).
+    '''
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = json.load(file)["summary"]
+
+    regressions = []
+
+    for pipeline, row in summary.items():
+        for metric in ("p50_ms", "p95_ms", "tool_calls_per_query", "tokens_per_query", "mal_requests_per_query"):
+            before = baseline.get(pipeline, {}).get(metric)
+            if before and row[metric] > before * (1 + tolerance):
+                regressions.append(f"{pipeline} {metric}: {before} -> {row[metric]}")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency benchmark for MALAI's agent pipelines.")
+    parser.add_argument("--pipeline", choices=["react", "graph", "both"], default="both")
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--runs", type=int, default=5, help="measured runs per query")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured runs per query")
+    parser.add_argument("--warm", action="store_true", help="keep the MAL response caches between runs")
+    parser.add_argument("--mal-latency", type=float, default=0.05, help="seconds the fake MAL server takes per response")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds before the fake model's first token")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds between the fake model's streamed tokens")
+    parser.add_argument("--p401", type=float, default=0.0, help="chance a MAL request gets a 401")
+    parser.add_argument("--p429", type=float, default=0.0, help="chance a MAL request gets a 429")
+    parser.add_argument("--no-rate-limit", action="store_true", help="lift the client's MAL rate limit")
+    parser.add_argument("--output", help="write the raw results and summary to this JSON file")
+    parser.add_argument("--baseline", help="fail if results are worse than this earlier --output file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against --baseline, as a fraction")
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as file:
+        corpus = json.load(file)
+
+    fake = FakeMAL(latency=args.mal_latency, p401=args.p401, p429=args.p429)
+    fake.start()
+    configure(fake, args)
+
+    pipelines = ["react", "graph"] if args.pipeline == "both" else [args.pipeline]
+
+    results = []
+    for pipeline in pipelines:
+        results += asyncio.run(benchmark(fake, pipeline, corpus, args))
+
+    fake.stop()
+
+    summary = summarize(results)
+    print_table(summary)
+
+    from shaping import savings
+
+    # Tool output size as JSON against the compact encoding, whichever MAL_COMPACT_RESPONSES sent.
+    tool_savings = savings.report()
+    if tool_savings:
+        print()
+        print("tool".ljust(24) + "".join(column.rjust(16) for column in ("calls", "tokens_before", "tokens_after", "saved_percent")))
+        for tool_name, row in sorted(tool_savings.items()):
+            print(tool_name.ljust(24) + "".join(str(row[column]).rjust(16) for column in ("calls", "tokens_before", "tokens_after", "saved_percent")))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"summary": summary, "results": results, "tool_savings": tool_savings, "settings": vars(args)}, file, indent=4)
+
+    if args.baseline:
+        regressions = check_baseline(summary, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
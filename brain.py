@@ -1,5 +1,5 @@
 import os
-from langchain import hub
+import time
 from langchain_ollama import ChatOllama
 from langchain_groq import ChatGroq
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -13,25 +13,37 @@ from langchain_azure_ai.chat_models import AzureAIChatCompletionsModel
 from langchain_aws import ChatBedrockConverse
 from langchain_anthropic import ChatAnthropic
 from langchain_mistralai import ChatMistralAI
-from langchain_huggingface import ChatHuggingFace, HuggingFaceEndpoint, HuggingFacePipeline
-from transformers import BitsAndBytesConfig
+from langchain_huggingface import ChatHuggingFace, HuggingFaceEndpoint
 from langchain.agents import create_react_agent, AgentExecutor
 from dotenv import load_dotenv
-from api import refresh_access_token, search_anime, anime_details, ranked_anime, seasonal_anime, get_user_anime_list, update_anime_list, delete_anime_from_list, user_details, search_manga, manga_details, ranked_manga, get_user_manga_list, update_manga_list, delete_manga_from_list, get_forum_boards, get_forum_topics, read_forum_topic
-from langfuse import Langfuse
-from langfuse.langchain import CallbackHandler
+from api import refresh_access_token, search_anime, anime_details, anime_details_bulk, ranked_anime, seasonal_anime, get_user_anime_list, anime_list_summary, update_anime_list, delete_anime_from_list, user_details, search_manga, manga_details, manga_details_bulk, ranked_manga, get_user_manga_list, manga_list_summary, update_manga_list, delete_manga_from_list, get_forum_boards, get_forum_topics, read_forum_topic
+from prompts import load_react_prompt
+from registry import Registry
+from local_models import ModelResidency
+from cassette import record_model
+from tracing import tracer
+from metrics import llm_call_seconds, llm_first_token_seconds, query_seconds, agent_iterations
 
-def MALAI(query, provider, model, hf_model):
+load_dotenv()
 
-    load_dotenv()
+prompt = load_react_prompt()
 
-    langfuse = Langfuse(
-        secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
-        public_key=os.getenv("LANGFUSE_PUBLIC_KEY"),
-        host=os.getenv("LANGFUSE_HOST")
-    )
+tools = [refresh_access_token, search_anime, anime_details, anime_details_bulk, ranked_anime, seasonal_anime, get_user_anime_list, anime_list_summary, update_anime_list, delete_anime_from_list, user_details, search_manga, manga_details, manga_details_bulk, ranked_manga, get_user_manga_list, manga_list_summary, update_manga_list, delete_manga_from_list, get_forum_boards, get_forum_topics, read_forum_topic]
+
+executors = Registry(
+    maxsize=int(os.getenv("MALAI_MAX_EXECUTORS", 8)),
+    idle_timeout=float(os.getenv("MALAI_EXECUTOR_IDLE_TIMEOUT", 1800))
+)
+
+memory_budget = os.getenv("HF_LOCAL_MEMORY_BUDGET_GB")
+
+local_models = ModelResidency(
+    max_models=int(os.getenv("HF_LOCAL_MAX_MODELS", 1)),
+    memory_budget=float(memory_budget) * 1024 ** 3 if memory_budget else None,
+    on_evict=lambda model_id: executors.discard(("HuggingFace Local", model_id))
+)
 
-    langfuse_handler = CallbackHandler()
+def build_llm(provider, model, hf_model):
 
     if provider == "Ollama":
         llm = ChatOllama(
@@ -120,24 +132,93 @@ def MALAI(query, provider, model, hf_model):
         )
 
     if provider == "HuggingFace Local":
-        quant_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4"
-        )
-        llm = HuggingFacePipeline.from_model_id(
-            model_id=hf_model,
-            task="text-generation",
-            model_kwargs={
-                "quantization_config": quant_config
-            }
-        )
+        llm = local_models.get(hf_model)
+
+    return llm
 
-    prompt = hub.pull("hwchase17/react")
-    tools = [refresh_access_token, search_anime, anime_details, ranked_anime, seasonal_anime, get_user_anime_list, update_anime_list, delete_anime_from_list, user_details, search_manga, manga_details, ranked_manga, get_user_manga_list, update_manga_list, delete_manga_from_list, get_forum_boards, get_forum_topics, read_forum_topic]
+def build_executor(provider, model, hf_model):
+    # With a cassette configured, model calls are recorded or replayed.
+    llm = record_model(build_llm(provider, model, hf_model))
 
     agent = create_react_agent(llm, tools, prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True, handle_parsing_errors=False)
 
-    response = agent_executor.invoke({"input": query}, config={"callbacks": [langfuse_handler]})
+    return AgentExecutor(agent=agent, tools=tools, verbose=True, handle_parsing_errors=False)
+
+def executor_key(provider, model, hf_model):
+    if provider.startswith("HuggingFace"):
+        return (provider, hf_model)
+    return (provider, model)
+
+def chunk_text(chunk):
+    content = getattr(chunk, "content", None)
+
+    if content is None:
+        return getattr(chunk, "text", "")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return content
+
+def render_steps(steps, thought):
+    return "\n".join(steps + [thought.strip()]).strip()
+
+async def MALAI(query, provider, model, hf_model):
+    '''
+    Runs the agent and streams its progress.
+    Yields the tool calls made so far and the model's current thought, then the final answer token by token once the model starts writing it.
+    '''
+
+    key = executor_key(provider, model, hf_model)
+    labels = {"provider": key[0], "model": key[1]}
+
+    agent_executor = executors.get(
+        key,
+        lambda: build_executor(provider, model, hf_model)
+    )
+
+    steps = []
+    thought = ""
+    output = None
+
+    # Model calls are timed from the events already being streamed, so measuring adds no callbacks.
+    started = time.perf_counter()
+    calls = {}
+    first_token = set()
+
+    async for event in agent_executor.astream_events({"input": query}, config={"callbacks": tracer.callbacks()}, version="v2"):
+        kind = event["event"]
+
+        if kind in ("on_chat_model_start", "on_llm_start"):
+            thought = ""
+            calls[event["run_id"]] = time.perf_counter()
+            first_token.add(event["run_id"])
+
+        elif kind in ("on_chat_model_end", "on_llm_end"):
+            if event["run_id"] in calls:
+                llm_call_seconds.observe(time.perf_counter() - calls[event["run_id"]], **labels)
+
+        elif kind in ("on_chat_model_stream", "on_llm_stream"):
+            if event["run_id"] in first_token:
+                first_token.discard(event["run_id"])
+                llm_first_token_seconds.observe(time.perf_counter() - calls[event["run_id"]], **labels)
+
+            thought += chunk_text(event["data"]["chunk"])
+
+            if "Final Answer:" in thought:
+                yield thought.split("Final Answer:", 1)[1].strip()
+            else:
+                yield render_steps(steps, thought)
+
+        elif kind == "on_tool_start":
+            tool_input = event["data"].get("input") or thought.split("Action Input:")[-1].strip()
+            steps.append(f"Action: {event['name']}({tool_input})")
+            thought = ""
+            yield render_steps(steps, thought)
+
+        elif kind == "on_chain_end" and event["name"] == "AgentExecutor":
+            output = event["data"]["output"]["output"]
+
+    query_seconds.observe(time.perf_counter() - started, **labels)
+    agent_iterations.observe(len(calls), **labels)
 
-    return response["output"]
\ No newline at end of file
+    if output is not None:
+        yield output
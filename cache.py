@@ -0,0 +1,143 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+class TTLCache:
+    '''
+    Bounded least-recently-used cache whose entries expire after ttl seconds.
+    Thread safe. Tracks hits and misses so the hit ratio can be reported.
+    '''
+
+    def __init__(self, maxsize=256, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, match):
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+class PersistentCache:
+    '''
+    SQLite backed response store that survives restarts.
+    Entries keep their fetch timestamp so the caller can decide whether they are fresh, stale but servable, or too old to use.
+    '''
+
+    def __init__(self, path, max_stale=7 * 86400):
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT NOT NULL,
+                params TEXT NOT NULL,
+                endpoint TEXT NOT NULL,
+                value TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (url, params)
+            )
+        """)
+        self.db.commit()
+
+    def get(self, key):
+        '''
+        Returns (value, age in seconds), or None if missing or older than max_stale.
+        '''
+        url, params = key
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, fetched_at FROM responses WHERE url = ? AND params = ?",
+                (url, json.dumps(params))
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        age = time.time() - row[1]
+        if age > self.max_stale:
+            return None
+
+        return json.loads(row[0]), age
+
+    def set(self, key, endpoint, value):
+        url, params = key
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (url, json.dumps(params), endpoint, json.dumps(value), time.time())
+            )
+            self.db.commit()
+
+    def invalidate(self, url):
+        with self.lock:
+            self.db.execute("DELETE FROM responses WHERE url = ? OR url LIKE ?", (url, url + "/%"))
+            self.db.commit()
+
+    def prune(self):
+        with self.lock:
+            self.db.execute("DELETE FROM responses WHERE fetched_at < ?", (time.time() - self.max_stale,))
+            self.db.commit()
+
+def normalize_params(params):
+    '''
+    Turns request parameters into a hashable key. None values are dropped and comma separated field lists are sorted, so equivalent requests share an entry.
+    '''
+    if not params:
+        return ()
+
+    normalized = []
+
+    for name, value in params.items():
+        if value is None:
+            continue
+
+        value = str(value).strip()
+        if name == "fields":
+            value = ",".join(sorted(field.strip() for field in value.split(",") if field.strip()))
+
+        normalized.append((name, value))
+
+    return tuple(sorted(normalized))
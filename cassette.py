@@ -0,0 +1,268 @@
+import os
+import json
+import gzip
+import time
+import asyncio
+import hashlib
+import warnings
+import threading
+
+from typing import Any
+from pydantic import ConfigDict
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.load import dumpd, load
+
+class CassetteMiss(LookupError):
+    '''
+    Raised in replay mode when a request was never recorded.
+    '''
+
+class Cassette:
+    '''
+    Content-addressed store of recorded responses, for replaying MAL and LLM traffic without external calls.
+    Each distinct request is one gzipped JSON file named after the hash of the request, so repeated requests are stored once.
+    mode is record (always call through and save), replay (never call through, unknown requests raise CassetteMiss) or auto (replay what exists, record the rest).
+    timing is fast (answer immediately) or recorded (wait as long as the original call took, divided by speed).
+    '''
+
+    def __init__(self, path, mode="replay", timing="fast", speed=1.0):
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def key(self, request):
+        return hashlib.sha256(json.dumps(request, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+    def file(self, kind, key):
+        return os.path.join(self.path, kind, key[:2], f"{key}.json.gz")
+
+    def load(self, kind, key):
+        # Entries are kept in memory once read, so a replay doesn't touch the disk twice for the same request.
+        with self.lock:
+            if (kind, key) in self.entries:
+                return self.entries[(kind, key)]
+
+        try:
+            with gzip.open(self.file(kind, key), "rt", encoding="utf-8") as file:
+                entry = json.load(file)
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            self.entries[(kind, key)] = entry
+        return entry
+
+    def save(self, kind, key, entry):
+        file_path = self.file(kind, key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        temporary = f"{file_path}.{threading.get_ident()}.tmp"
+        with gzip.open(temporary, "wt", encoding="utf-8") as file:
+            json.dump(entry, file, separators=(",", ":"))
+        os.replace(temporary, file_path)
+
+        with self.lock:
+            self.entries[(kind, key)] = entry
+
+    def delay(self, entry):
+        if self.timing == "recorded":
+            return entry.get("elapsed", 0) / self.speed
+        return 0
+
+    def lookup(self, kind, request):
+        '''
+        Returns (key, recorded entry or None). Raises CassetteMiss in replay mode.
+        '''
+        key = self.key(request)
+        entry = None if self.mode == "record" else self.load(kind, key)
+
+        if entry is None and self.mode == "replay":
+            raise CassetteMiss(f"No recorded {kind} response for {json.dumps(request, default=str)[:200]}")
+
+        return key, entry
+
+    def through(self, kind, request, call):
+        '''
+        Answers request from the cassette, or makes it with call() and records the result.
+        '''
+        key, entry = self.lookup(kind, request)
+
+        if entry is not None:
+            time.sleep(self.delay(entry))
+            return entry["response"]
+
+        started = time.perf_counter()
+        response = call()
+        self.save(kind, key, {"request": request, "response": response, "elapsed": time.perf_counter() - started})
+
+        return response
+
+    async def athrough(self, kind, request, call):
+        # Reading and writing cassette files happens in a thread, off the event loop.
+        key, entry = await asyncio.to_thread(self.lookup, kind, request)
+
+        if entry is not None:
+            await asyncio.sleep(self.delay(entry))
+            return entry["response"]
+
+        started = time.perf_counter()
+        response = await call()
+        await asyncio.to_thread(self.save, kind, key, {"request": request, "response": response, "elapsed": time.perf_counter() - started})
+
+        return response
+
+def load_quietly(data):
+    # langchain_core.load is marked beta and warns on every call.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return load(data)
+
+def as_chunk(message):
+    return AIMessageChunk(
+        content=message.content,
+        additional_kwargs=message.additional_kwargs,
+        response_metadata=message.response_metadata,
+        usage_metadata=message.usage_metadata,
+        tool_call_chunks=[
+            {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": index}
+            for index, call in enumerate(getattr(message, "tool_calls", []))
+        ]
+    )
+
+class CassetteChatModel(BaseChatModel):
+    '''
+    Wraps a chat model so its calls are recorded to and replayed from a cassette.
+    Streamed calls keep each chunk and when it arrived, so a replay streams the same way, at full speed or with the recorded timing.
+    A call recorded one way can be replayed the other, e.g. a streamed recording answers an invoke.
+    '''
+
+    model: BaseChatModel
+    cassette: Any
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def _llm_type(self):
+        return f"cassette-{self.model._llm_type}"
+
+    def bind_tools(self, tools, **kwargs):
+        # The wrapped model formats the tools, the wrapper passes them back to it on every call.
+        return self.bind(**self.model.bind_tools(tools, **kwargs).kwargs)
+
+    def request(self, messages, stop, kwargs):
+        return [self.model._get_llm_string(stop=stop, **kwargs), dumpd(messages)]
+
+    def result(self, response):
+        if "generations" in response:
+            return ChatResult(generations=load_quietly(response["generations"]))
+        chunks = [ChatGenerationChunk(message=load_quietly(chunk)) for chunk in response["chunks"]]
+        return generate_from_stream(iter(chunks))
+
+    def chunks(self, response):
+        if "chunks" in response:
+            return zip(response["offsets"], [load_quietly(chunk) for chunk in response["chunks"]])
+        message = load_quietly(response["generations"])[0].message
+        return [(0, as_chunk(message))]
+
+    def replayed_chunks(self, entry):
+        previous = 0
+        for offset, chunk in self.chunks(entry["response"]):
+            yield max(0, offset - previous) / self.cassette.speed if self.cassette.timing == "recorded" else 0, ChatGenerationChunk(message=chunk)
+            previous = offset
+
+    def recorded_chunks(self, key, request, chunks):
+        started = time.perf_counter()
+        recorded = []
+        offsets = []
+
+        for chunk in chunks:
+            recorded.append(dumpd(chunk.message))
+            offsets.append(time.perf_counter() - started)
+            yield chunk
+
+        self.cassette.save("llm", key, {"request": request, "response": {"chunks": recorded, "offsets": offsets}, "elapsed": time.perf_counter() - started})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        request = self.request(messages, stop, kwargs)
+        key, entry = self.cassette.lookup("llm", request)
+
+        if entry is not None:
+            time.sleep(self.cassette.delay(entry))
+            return self.result(entry["response"])
+
+        started = time.perf_counter()
+        result = self.model._generate(messages, stop=stop, **kwargs)
+        self.cassette.save("llm", key, {"request": request, "response": {"generations": dumpd(result.generations)}, "elapsed": time.perf_counter() - started})
+
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        request = self.request(messages, stop, kwargs)
+        key, entry = await asyncio.to_thread(self.cassette.lookup, "llm", request)
+
+        if entry is not None:
+            await asyncio.sleep(self.cassette.delay(entry))
+            return self.result(entry["response"])
+
+        started = time.perf_counter()
+        result = await self.model._agenerate(messages, stop=stop, **kwargs)
+        await asyncio.to_thread(self.cassette.save, "llm", key, {"request": request, "response": {"generations": dumpd(result.generations)}, "elapsed": time.perf_counter() - started})
+
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        request = self.request(messages, stop, kwargs)
+        key, entry = self.cassette.lookup("llm", request)
+
+        if entry is None:
+            yield from self.recorded_chunks(key, request, self.model._stream(messages, stop=stop, **kwargs))
+            return
+
+        for delay, chunk in self.replayed_chunks(entry):
+            if delay:
+                time.sleep(delay)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        request = self.request(messages, stop, kwargs)
+        key, entry = await asyncio.to_thread(self.cassette.lookup, "llm", request)
+
+        if entry is None:
+            started = time.perf_counter()
+            recorded = []
+            offsets = []
+
+            async for chunk in self.model._astream(messages, stop=stop, **kwargs):
+                recorded.append(dumpd(chunk.message))
+                offsets.append(time.perf_counter() - started)
+                yield chunk
+
+            await asyncio.to_thread(self.cassette.save, "llm", key, {"request": request, "response": {"chunks": recorded, "offsets": offsets}, "elapsed": time.perf_counter() - started})
+            return
+
+        for delay, chunk in self.replayed_chunks(entry):
+            if delay:
+                await asyncio.sleep(delay)
+            yield chunk
+
+def record_model(llm):
+    '''
+    Wraps llm for the configured cassette. Only chat models are wrapped, anything else is returned unchanged.
+    '''
+    if cassette is None or not isinstance(llm, BaseChatModel):
+        return llm
+    return CassetteChatModel(model=llm, cassette=cassette)
+
+cassette = None
+if os.getenv("MALAI_CASSETTE_MODE"):
+    cassette = Cassette(
+        os.getenv("MALAI_CASSETTE_DIR", "cassettes"),
+        mode=os.getenv("MALAI_CASSETTE_MODE"),
+        timing=os.getenv("MALAI_CASSETTE_TIMING", "fast"),
+        speed=float(os.getenv("MALAI_CASSETTE_SPEED", 1))
+    )
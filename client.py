@@ -0,0 +1,680 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+import threading
+from typing import NamedTuple
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv, dotenv_values, set_key
+from cache import TTLCache, PersistentCache, normalize_params
+from ratelimit import TokenBucket, SharedTokenBucket
+from singleflight import SingleFlight
+from cassette import cassette
+from metrics import metrics, mal_request_seconds, token_refreshes
+
+load_dotenv()
+
+# Overridable so the client can be pointed at a stand-in server, e.g. bench/fake_mal.py.
+MAL_API_URL = os.getenv("MAL_API_URL", "https://api.myanimelist.net/v2").rstrip("/")
+TOKEN_URL = os.getenv("MAL_TOKEN_URL", "https://myanimelist.net/v1/oauth2/token")
+
+# endpoint: (max entries, ttl in seconds)
+CACHE_POLICIES = {
+    "anime_details": (1024, 3600),
+    "manga_details": (1024, 3600),
+    "search_anime": (256, 3600),
+    "search_manga": (256, 3600),
+    "ranked_anime": (128, 3600),
+    "ranked_manga": (128, 3600),
+    "seasonal_anime": (128, 3600),
+    "get_forum_boards": (1, 86400)
+}
+
+# Catalogue endpoints that are also kept in the persistent cache, if one is configured.
+PERSISTENT_ENDPOINTS = {"anime_details", "manga_details", "ranked_anime", "ranked_manga"}
+
+class MALRequest(NamedTuple):
+    '''
+    Description of a single MyAnimeList API call. cache names the response cache to use for GETs, if any.
+    '''
+    method: str
+    url: str
+    params: dict | None = None
+    data: dict | None = None
+    cache: str | None = None
+
+def without_none(values):
+    '''
+    requests drops None valued parameters, httpx would send them as empty strings.
+    '''
+    if values is None:
+        return None
+    return {name: value for name, value in values.items() if value is not None}
+
+def next_page(page):
+    if isinstance(page, dict):
+        return (page.get("paging") or {}).get("next")
+    return None
+
+def endpoint_name(url):
+    '''
+    Low-cardinality name for a URL in metrics: ids and user names are replaced, e.g. /anime/:id/my_list_status or /users/:user/animelist.
+    '''
+    if url == TOKEN_URL:
+        return "/oauth2/token"
+
+    segments = url.removeprefix(MAL_API_URL).split("?")[0].strip("/").split("/")
+    for index, segment in enumerate(segments):
+        if segment.isdigit():
+            segments[index] = ":id"
+        elif index and segments[index - 1] == "users" and segment != "@me":
+            segments[index] = ":user"
+
+    return "/" + "/".join(segments)
+
+def retry_after(response):
+    '''
+    Seconds the server asked us to wait, from a Retry-After header holding either seconds or an HTTP date.
+    '''
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def parse_expiry(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class TokenStore:
+    '''
+    In-memory copy of the MyAnimeList OAuth tokens.
+    version increases every time the tokens change, so a caller can tell whether the token it used has since been replaced.
+    With watch enabled, the .env file is only re-parsed when its mtime changes.
+    expires_at is the unix time the access token expires, when known.
+    '''
+
+    def __init__(self, env_file=".env", watch=True):
+        self.env_file = env_file
+        self.watch = watch
+        self.lock = threading.Lock()
+        self.mtime = self._mtime()
+        # .env wins over the process environment, which may still hold tokens from before a refresh, e.g. Codespaces secrets.
+        values = dotenv_values(self.env_file) if self.mtime is not None else {}
+        self.state = (values.get("ACCESS_TOKEN") or os.getenv("ACCESS_TOKEN"), values.get("REFRESH_TOKEN") or os.getenv("REFRESH_TOKEN"), 0)
+        self.expires_at = parse_expiry(values.get("ACCESS_TOKEN_EXPIRES_AT") if values.get("ACCESS_TOKEN") else os.getenv("ACCESS_TOKEN_EXPIRES_AT"))
+
+    def _mtime(self):
+        try:
+            return os.stat(self.env_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload(self):
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return
+
+        with self.lock:
+            if mtime == self.mtime:
+                return
+
+            values = dotenv_values(self.env_file)
+            access_token, refresh_token, version = self.state
+            access_token = values.get("ACCESS_TOKEN") or access_token
+            refresh_token = values.get("REFRESH_TOKEN") or refresh_token
+
+            if (access_token, refresh_token) != self.state[:2]:
+                self.state = (access_token, refresh_token, version + 1)
+                self.expires_at = parse_expiry(values.get("ACCESS_TOKEN_EXPIRES_AT"))
+            self.mtime = mtime
+
+    def snapshot(self):
+        if self.watch:
+            self._reload()
+        return self.state
+
+    @property
+    def access_token(self):
+        return self.snapshot()[0]
+
+    @property
+    def refresh_token(self):
+        return self.snapshot()[1]
+
+    @property
+    def version(self):
+        return self.snapshot()[2]
+
+    def expiring(self, margin):
+        return self.expires_at is not None and self.expires_at - margin < time.time()
+
+    def update(self, access_token, refresh_token, expires_in=None):
+        with self.lock:
+            self.state = (access_token, refresh_token, self.state[2] + 1)
+            self.expires_at = time.time() + float(expires_in) if expires_in else None
+
+            os.environ["ACCESS_TOKEN"] = access_token
+            os.environ["REFRESH_TOKEN"] = refresh_token
+            os.environ["ACCESS_TOKEN_EXPIRES_AT"] = str(self.expires_at or "")
+
+            if os.path.exists(self.env_file):
+                set_key(self.env_file, "ACCESS_TOKEN", access_token)
+                set_key(self.env_file, "REFRESH_TOKEN", refresh_token)
+                set_key(self.env_file, "ACCESS_TOKEN_EXPIRES_AT", str(self.expires_at or ""))
+                self.mtime = self._mtime()
+
+class MALClient:
+    '''
+    Shared HTTP client for the MyAnimeList API.
+    Keeps a pool of keep-alive connections so every tool call and every user reuses the same TCP+TLS sessions.
+    Every blocking method has an async counterpart backed by httpx, so async callers overlap I/O without a thread per request.
+    '''
+
+    def __init__(self, tokens, limiter, pool_size=10, timeout=10.0, retries=3, backoff=0.5, max_backoff=30.0, cache=True, persistent_cache=None, refresh_margin=300.0, cassette=None):
+        self.tokens = tokens
+        self.refresh_margin = refresh_margin
+        self.token_lock = threading.Lock()
+        self.on_refresh = []
+        self.on_write = []
+        self.cassette = cassette
+        self.limiter = limiter
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.async_sessions = weakref.WeakKeyDictionary()
+        self.flights = SingleFlight()
+        self.caches = {}
+        self.persistent = persistent_cache
+        self.refreshing = set()
+        self.refresh_lock = threading.Lock()
+        self.refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mal-cache-refresh")
+        self.prefetcher = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mal-prefetch")
+
+        if cache:
+            for endpoint, (maxsize, ttl) in CACHE_POLICIES.items():
+                self.caches[endpoint] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        # Only connection errors are retried here, status codes are handled by retry_delay with the rate limiter.
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=[],
+            allowed_methods=["GET", "PUT", "DELETE"]
+        )
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def credentials(self, auth):
+        '''
+        Returns the request headers and the token version they were built from.
+        '''
+        if not auth:
+            return None, None
+
+        access_token, refresh_token, version = self.tokens.snapshot()
+
+        return {
+            "Authorization": f"Bearer {access_token}"
+        }, version
+
+    def refresh_tokens(self, stale_version=None):
+        '''
+        Exchanges the refresh token for a new pair. Only one refresh runs at a time.
+        Callers pass the token version that failed for them. If another caller has already replaced it, the refresh is skipped and they simply retry with the new token.
+        Returns True once a newer token is available.
+        '''
+        with self.token_lock:
+            if stale_version is not None and self.tokens.version != stale_version:
+                return True
+
+            params = {
+                "client_id": os.getenv("CLIENT_ID"),
+                "client_secret": os.getenv("CLIENT_SECRET"),
+                "grant_type": "refresh_token",
+                "refresh_token": self.tokens.refresh_token
+            }
+
+            response = self.request("POST", TOKEN_URL, data=params, auth=False)
+
+            if "access_token" not in response:
+                raise RuntimeError(f"Token refresh failed: {response}")
+
+            self.tokens.update(response["access_token"], response["refresh_token"], response.get("expires_in"))
+            token_refreshes.inc(result="success")
+
+        for listener in self.on_refresh:
+            listener(response["access_token"], response["refresh_token"])
+
+        return True
+
+    def safe_refresh(self, stale_version):
+        try:
+            return self.refresh_tokens(stale_version)
+        except Exception as e:
+            token_refreshes.inc(result="failure")
+            print(f"Could not refresh the MyAnimeList access token: {e}")
+            # Stop refreshing ahead of time until a refresh succeeds, 401s still trigger one.
+            self.tokens.expires_at = None
+            return False
+
+    def retry_delay(self, method, response, attempt):
+        '''
+        How long to wait before retrying response, or None if it should be returned as is.
+        429s are always retried, and the caller holds back everyone else by penalizing the rate limiter. 5xx are retried for idempotent methods only.
+        '''
+        status = response.status_code
+
+        if attempt >= self.retries:
+            return None
+        if status != 429 and not (status >= 500 and method in ("GET", "PUT", "DELETE")):
+            return None
+
+        delay = retry_after(response)
+        if delay is None:
+            delay = self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+        return min(delay, self.max_backoff)
+
+    def observe(self, method, url, status, started):
+        # Time on the wire only, waiting for the rate limiter or a retry isn't counted.
+        mal_request_seconds.observe(time.perf_counter() - started, method=method, endpoint=endpoint_name(url), status=status)
+
+    def recorded(self, method, url, params, data):
+        '''
+        The cassette key for a call. Headers are left out, so tokens never reach the cassette and a refreshed token still matches.
+        The base URL is left out too, so a cassette recorded against MAL replays against a stand-in and the other way round.
+        paging.next links in recorded responses still carry the host they were recorded against, so other hosts are reduced to their path after /v2 as well.
+        '''
+        if url.startswith(MAL_API_URL):
+            path = url[len(MAL_API_URL):]
+        else:
+            parts = urlsplit(url)
+            path = parts.path.removeprefix("/v2") + (f"?{parts.query}" if parts.query else "")
+
+        return [method, path, normalize_params(params), normalize_params(data)]
+
+    def request(self, method, url, params=None, data=None, auth=True):
+        # Token refreshes are never recorded, since they carry the client secret.
+        if self.cassette is not None and url != TOKEN_URL:
+            result = self.cassette.through("mal", self.recorded(method, url, params, data), lambda: self.send_request(method, url, params, data, auth))
+        else:
+            result = self.send_request(method, url, params, data, auth)
+
+        if method in ("PUT", "DELETE"):
+            self.written(method, url, data, result)
+
+        return result
+
+    def send_request(self, method, url, params=None, data=None, auth=True):
+        refreshed = False
+        attempt = 0
+
+        while True:
+            # Refresh ahead of expiry rather than waiting for a 401.
+            if auth and self.tokens.expiring(self.refresh_margin):
+                self.safe_refresh(self.tokens.version)
+            headers, version = self.credentials(auth)
+
+            self.limiter.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, headers=headers, params=params, data=data, timeout=self.timeout)
+            except Exception:
+                self.observe(method, url, "error", started)
+                raise
+            self.observe(method, url, response.status_code, started)
+
+            # A rejected token is refreshed once and the call retried transparently.
+            if auth and response.status_code == 401 and not refreshed:
+                refreshed = True
+                if self.safe_refresh(version):
+                    continue
+
+            delay = self.retry_delay(method, response, attempt)
+            attempt += 1
+            if delay is None:
+                break
+            if response.status_code == 429:
+                self.limiter.penalize(delay)
+            time.sleep(delay)
+
+        return response.json()
+
+    def async_session(self):
+        '''
+        httpx clients are bound to the event loop they were first used on, so each loop gets its own pool.
+        '''
+        loop = asyncio.get_running_loop()
+        session = self.async_sessions.get(loop)
+
+        if session is None:
+            session = httpx.AsyncClient(
+                timeout=self.timeout,
+                # With a custom transport, httpx takes the pool limits from the transport, not the client.
+                transport=httpx.AsyncHTTPTransport(
+                    retries=self.retries,
+                    limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+                )
+            )
+            self.async_sessions[loop] = session
+
+        return session
+
+    async def arequest(self, method, url, params=None, data=None, auth=True):
+        if self.cassette is not None and url != TOKEN_URL:
+            result = await self.cassette.athrough("mal", self.recorded(method, url, params, data), lambda: self.asend_request(method, url, params, data, auth))
+        else:
+            result = await self.asend_request(method, url, params, data, auth)
+
+        # Invalidating the persistent cache and the mirror's write-through both hit SQLite.
+        if method in ("PUT", "DELETE"):
+            await asyncio.to_thread(self.written, method, url, data, result)
+
+        return result
+
+    async def asend_request(self, method, url, params=None, data=None, auth=True):
+        refreshed = False
+        attempt = 0
+
+        while True:
+            if auth and self.tokens.expiring(self.refresh_margin):
+                await asyncio.to_thread(self.safe_refresh, self.tokens.version)
+            headers, version = self.credentials(auth)
+
+            await self.limiter.aacquire()
+            started = time.perf_counter()
+            try:
+                response = await self.async_session().request(method, url, headers=headers, params=without_none(params), data=without_none(data))
+            except Exception:
+                self.observe(method, url, "error", started)
+                raise
+            self.observe(method, url, response.status_code, started)
+
+            if auth and response.status_code == 401 and not refreshed:
+                refreshed = True
+                if await asyncio.to_thread(self.safe_refresh, version):
+                    continue
+
+            delay = self.retry_delay(method, response, attempt)
+            attempt += 1
+            if delay is None:
+                break
+            if response.status_code == 429:
+                await self.limiter.apenalize(delay)
+            await asyncio.sleep(delay)
+
+        return response.json()
+
+    def cacheable(self, url, params):
+        '''
+        Responses for the authenticated user are never cached.
+        '''
+        fields = str((params or {}).get("fields") or "")
+        return "@me" not in url and "my_list_status" not in fields
+
+    def cached(self, key, cache, url, params, auth):
+        '''
+        Returns the cached response for key, or None if it has to be fetched.
+        '''
+        response = self.caches[cache].get(key)
+        if response is not None:
+            return response
+
+        return self.stored(key, cache, url, params, auth)
+
+    def persists(self, cache):
+        return self.persistent is not None and cache in PERSISTENT_ENDPOINTS
+
+    def stored(self, key, cache, url, params, auth):
+        '''
+        Looks key up in the persistent cache. Blocks on SQLite, async callers run it in a thread.
+        '''
+        store = self.caches[cache]
+
+        if self.persists(cache):
+            stored = self.persistent.get(key)
+
+            if stored is not None:
+                response, age = stored
+
+                # Stale entries are served straight away and refreshed in the background.
+                if age > store.ttl:
+                    self.revalidate(key, cache, url, params, auth)
+                else:
+                    store.set(key, response)
+
+                return response
+
+        return None
+
+    def storable(self, cache, response):
+        return cache is not None and isinstance(response, dict) and "error" not in response
+
+    def store(self, key, cache, response):
+        if self.storable(cache, response):
+            self.caches[cache].set(key, response)
+            if self.persists(cache):
+                self.persistent.set(key, cache, response)
+
+    async def astore(self, key, cache, response):
+        # The persistent cache commits on every write, so it is kept off the event loop.
+        if self.storable(cache, response):
+            self.caches[cache].set(key, response)
+            if self.persists(cache):
+                await asyncio.to_thread(self.persistent.set, key, cache, response)
+
+    def get(self, url, params=None, auth=True, cache=None):
+        key = (url, normalize_params(params))
+
+        if cache in self.caches and self.cacheable(url, params):
+            response = self.cached(key, cache, url, params, auth)
+            if response is not None:
+                return response
+        else:
+            cache = None
+
+        # Identical requests already in flight share one upstream call.
+        return self.flights.do(key, lambda: self.fetch(key, cache, url, params, auth))
+
+    async def aget(self, url, params=None, auth=True, cache=None):
+        key = (url, normalize_params(params))
+
+        if cache in self.caches and self.cacheable(url, params):
+            # Memory first, the persistent cache is SQLite and is read in a thread.
+            response = self.caches[cache].get(key)
+            if response is None and self.persists(cache):
+                response = await asyncio.to_thread(self.stored, key, cache, url, params, auth)
+            if response is not None:
+                return response
+        else:
+            cache = None
+
+        return await self.flights.ado(key, lambda: self.afetch(key, cache, url, params, auth))
+
+    def fetch(self, key, cache, url, params, auth):
+        response = self.request("GET", url, params=params, auth=auth)
+        self.store(key, cache, response)
+        return response
+
+    async def afetch(self, key, cache, url, params, auth):
+        response = await self.arequest("GET", url, params=params, auth=auth)
+        await self.astore(key, cache, response)
+        return response
+
+    def revalidate(self, key, cache, url, params, auth):
+        with self.refresh_lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.flights.do(key, lambda: self.fetch(key, cache, url, params, auth))
+            except Exception as e:
+                print(f"Background refresh of {url} failed: {e}")
+            finally:
+                with self.refresh_lock:
+                    self.refreshing.discard(key)
+
+        self.refresher.submit(refresh)
+
+    def invalidate(self, url):
+        '''
+        Drops cached responses for url and anything nested under it.
+        '''
+        for store in self.caches.values():
+            store.invalidate(lambda key: key[0] == url or key[0].startswith(url + "/"))
+
+        if self.persistent is not None:
+            self.persistent.invalidate(url)
+
+    def written(self, method, url, data, result):
+        '''
+        Drops cached copies of a resource after it was changed, then tells on_write listeners, e.g. the list mirror.
+        '''
+        self.invalidate(url.removesuffix("/my_list_status"))
+
+        for listener in self.on_write:
+            try:
+                listener(method, url, data, result)
+            except Exception as e:
+                print(f"Write listener failed for {method} {url}: {e}")
+
+    def cache_stats(self):
+        return {endpoint: store.stats() for endpoint, store in self.caches.items()}
+
+    def cache_hit_ratios(self):
+        ratios = {}
+        for endpoint, stats in self.cache_stats().items():
+            lookups = stats["hits"] + stats["misses"]
+            ratios[(endpoint,)] = stats["hits"] / lookups if lookups else 0
+        return ratios
+
+    def put(self, url, data=None, auth=True):
+        return self.request("PUT", url, data=data, auth=auth)
+
+    def delete(self, url, data=None, auth=True):
+        return self.request("DELETE", url, data=data, auth=auth)
+
+    def post(self, url, data=None, auth=True):
+        return self.request("POST", url, data=data, auth=auth)
+
+    async def aput(self, url, data=None, auth=True):
+        return await self.arequest("PUT", url, data=data, auth=auth)
+
+    async def adelete(self, url, data=None, auth=True):
+        return await self.arequest("DELETE", url, data=data, auth=auth)
+
+    async def apost(self, url, data=None, auth=True):
+        return await self.arequest("POST", url, data=data, auth=auth)
+
+    def paginate(self, url, params=None, max_pages=50):
+        '''
+        Yields every page of a paged endpoint by following paging.next.
+        The next page is already being fetched while the caller works on the current one.
+        '''
+        future = self.prefetcher.submit(self.get, url, params)
+        pages = 0
+
+        while future is not None:
+            page = future.result()
+            pages += 1
+
+            next_url = next_page(page)
+            future = None
+            if next_url and pages < max_pages:
+                future = self.prefetcher.submit(self.get, next_url)
+
+            yield page
+
+    async def apaginate(self, url, params=None, max_pages=50):
+        task = asyncio.ensure_future(self.aget(url, params))
+        pages = 0
+
+        while task is not None:
+            page = await task
+            pages += 1
+
+            next_url = next_page(page)
+            task = None
+            if next_url and pages < max_pages:
+                task = asyncio.ensure_future(self.aget(next_url))
+
+            yield page
+
+    def send(self, request):
+        if request.method == "GET":
+            return self.get(request.url, params=request.params, cache=request.cache)
+        return self.request(request.method, request.url, params=request.params, data=request.data)
+
+    async def asend(self, request):
+        if request.method == "GET":
+            return await self.aget(request.url, params=request.params, cache=request.cache)
+        return await self.arequest(request.method, request.url, params=request.params, data=request.data)
+
+persistent_cache = None
+if os.getenv("MAL_CACHE_DB"):
+    persistent_cache = PersistentCache(
+        os.getenv("MAL_CACHE_DB"),
+        max_stale=float(os.getenv("MAL_CACHE_MAX_STALE", 7 * 86400))
+    )
+    persistent_cache.prune()
+
+rate = float(os.getenv("MAL_RATE_LIMIT", 2))
+burst = int(os.getenv("MAL_RATE_BURST", 5))
+
+if os.getenv("MAL_RATE_LIMIT_DB"):
+    limiter = SharedTokenBucket(os.getenv("MAL_RATE_LIMIT_DB"), rate=rate, burst=burst)
+else:
+    limiter = TokenBucket(rate=rate, burst=burst)
+
+tokens = TokenStore(
+    env_file=os.getenv("MAL_ENV_FILE", ".env"),
+    watch=os.getenv("MAL_WATCH_ENV", "true").lower() == "true"
+)
+
+client = MALClient(
+    tokens,
+    limiter,
+    pool_size=int(os.getenv("MAL_POOL_SIZE", 10)),
+    timeout=float(os.getenv("MAL_TIMEOUT", 10)),
+    retries=int(os.getenv("MAL_RETRIES", 3)),
+    backoff=float(os.getenv("MAL_RETRY_BACKOFF", 0.5)),
+    max_backoff=float(os.getenv("MAL_MAX_BACKOFF", 30)),
+    cache=os.getenv("MAL_CACHE", "true").lower() == "true",
+    persistent_cache=persistent_cache,
+    refresh_margin=float(os.getenv("MAL_REFRESH_MARGIN", 300)),
+    cassette=cassette
+)
+
+# The caches already count hits and misses, so they are read when scraped rather than counted again.
+metrics.collected("malai_cache_hits_total", "MyAnimeList response cache hits.", ["cache"], lambda: {(endpoint,): stats["hits"] for endpoint, stats in client.cache_stats().items()}, kind="counter")
+metrics.collected("malai_cache_misses_total", "MyAnimeList response cache misses.", ["cache"], lambda: {(endpoint,): stats["misses"] for endpoint, stats in client.cache_stats().items()}, kind="counter")
+metrics.collected("malai_cache_hit_ratio", "Share of MyAnimeList response cache lookups that were hits.", ["cache"], client.cache_hit_ratios)
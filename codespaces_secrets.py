@@ -1,4 +1,6 @@
 import os
+import atexit
+import threading
 import requests
 from nacl import public, encoding
 import json
@@ -7,38 +9,116 @@ import json
 
 GITHUB_API_URL = "https://api.github.com"
 
+session = requests.Session()
+
+# (owner, repo): (key_id, SealedBox). The repo public key only changes when GitHub rotates it.
+public_keys = {}
+public_keys_lock = threading.Lock()
+
 def encrypt_secret(public_key: str, secret_value: str) -> str:
     """Encrypts a Unicode string value using a Base64-encoded public key."""
     public_key_bytes = public_key.encode("utf-8")
     sealed_box = public.SealedBox(public.PublicKey(public_key_bytes, encoder=encoding.Base64Encoder))
+    return seal(sealed_box, secret_value)
+
+def seal(sealed_box, secret_value: str) -> str:
     encrypted = sealed_box.encrypt(secret_value.encode("utf-8"))
     return encoding.Base64Encoder.encode(encrypted).decode("utf-8")
 
+def github_headers():
+    return {
+        "Authorization": f"token {os.getenv('GH_TOKEN')}",
+        "Accept": "application/vnd.github.v3+json"
+    }
+
+def get_public_key(owner, repo, refresh=False):
+    with public_keys_lock:
+        if not refresh and (owner, repo) in public_keys:
+            return public_keys[(owner, repo)]
+
+        public_key_url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/codespaces/secrets/public-key"
+
+        response = session.get(public_key_url, headers=github_headers(), timeout=10)
+        response.raise_for_status()
+
+        public_key_data = response.json()
+        sealed_box = public.SealedBox(public.PublicKey(public_key_data["key"].encode("utf-8"), encoder=encoding.Base64Encoder))
+
+        public_keys[(owner, repo)] = (public_key_data["key_id"], sealed_box)
+        return public_keys[(owner, repo)]
+
 def update_secret(SECRET_NAME, SECRET_VALUE):
-    GITHUB_TOKEN = os.getenv("GH_TOKEN")
     GITHUB_REPO_OWNER = os.getenv("GH_REPO_OWNER")
     GITHUB_REPO_NAME = os.getenv("GH_REPO_NAME")
 
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
+    update_secret_url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/codespaces/secrets/{SECRET_NAME}"
 
-    public_key_url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/codespaces/secrets/public-key"
+    for refresh in (False, True):
+        key_id, sealed_box = get_public_key(GITHUB_REPO_OWNER, GITHUB_REPO_NAME, refresh=refresh)
 
-    response = requests.get(public_key_url, headers=headers)
+        payload = {
+            "encrypted_value": seal(sealed_box, SECRET_VALUE),
+            "key_id": key_id,
+        }
 
-    public_key_data = response.json()
-    key_id = public_key_data["key_id"]
-    key_value = public_key_data["key"]
+        response = session.put(update_secret_url, headers=github_headers(), json=payload, timeout=10)
 
-    encrypted_value = encrypt_secret(key_value, SECRET_VALUE)
+        # A rejected payload usually means the key was rotated, so fetch it again and retry once.
+        if response.status_code not in (400, 422):
+            break
 
-    update_secret_url = f"{GITHUB_API_URL}/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/codespaces/secrets/{SECRET_NAME}"
+    response.raise_for_status()
+    return response
 
-    payload = {
-        "encrypted_value": encrypted_value,
-        "key_id": key_id,
-    }
+class SecretSync:
+    '''
+    Pushes secrets to GitHub on a background thread so token refreshes never wait on GitHub.
+    Only the latest value queued for each secret is sent.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.busy = False
+        self.thread = None
+
+    def queue(self, name, value):
+        with self.condition:
+            self.pending[name] = value
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="codespaces-secret-sync", daemon=True)
+                self.thread.start()
+
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.busy = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+
+                pending, self.pending = self.pending, {}
+                self.busy = True
+
+            for name, value in pending.items():
+                try:
+                    update_secret(name, value)
+                except Exception as e:
+                    print(f"Could not update Codespaces secret {name}: {e}")
+
+    def flush(self, timeout=10):
+        '''
+        Waits until everything queued so far has been sent.
+        '''
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout=timeout)
+
+secret_sync = SecretSync()
+
+atexit.register(secret_sync.flush)
 
-    response = requests.put(update_secret_url, headers=headers, json=payload)
\ No newline at end of file
+def queue_secret(SECRET_NAME, SECRET_VALUE):
+    secret_sync.queue(SECRET_NAME, SECRET_VALUE)
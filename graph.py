@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing_extensions import TypedDict
 from typing import Annotated
 
@@ -8,10 +9,12 @@ from langgraph.prebuilt import ToolNode
 
 from langchain_openai import AzureChatOpenAI
 from langchain_groq import ChatGroq
-from langchain_core.messages import ChatMessage
+from langchain_core.messages import ChatMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import tool
 
-from api import system_tools, anime_tools
+from cassette import record_model
+from api import system_tools, anime_tools, write_tools
 '''
 llm = ChatGroq(
     model="moonshotai/kimi-k2-instruct"
@@ -26,6 +29,8 @@ llm = AzureChatOpenAI(
     temperature=0
 )
 
+llm = record_model(llm)
+
 class State(TypedDict):
     messages: Annotated[list, add_messages]
     expert: Annotated[list, add_messages]
@@ -33,14 +38,47 @@ class State(TypedDict):
 builder = StateGraph(State)
 
 token_tool_node = ToolNode(system_tools)
-anime_tool_node = ToolNode(anime_tools)
 
-def anime_wrapper(state: State) -> dict:
-    results = anime_tool_node.invoke({
-        "messages": state["expert"]
-    })
+anime_tools_by_name = {anime_tool.name: anime_tool for anime_tool in anime_tools}
+
+# Shared by every graph run, so the limit also caps concurrent MAL calls across users.
+tool_pool = ThreadPoolExecutor(max_workers=int(os.getenv("MAL_TOOL_CONCURRENCY", 4)))
+
+def run_tool_call(tool_call, config) -> ToolMessage:
+    try:
+        return anime_tools_by_name[tool_call["name"]].invoke(tool_call, config)
+    except Exception as e:
+        return ToolMessage(
+            content=f"Error: {repr(e)}\n Please fix your mistakes.",
+            name=tool_call["name"],
+            tool_call_id=tool_call["id"],
+            status="error"
+        )
+
+def run_tool_calls(tool_calls, config) -> list:
+    '''
+    Runs consecutive read-only tool calls concurrently. Write tools run alone, in the order they were called, after everything before them has finished.
+    config is passed on explicitly, the pool's threads don't inherit the node's context, so callbacks and tracing would otherwise lose the tool runs.
+    '''
+    results = []
+    batch = []
+    run = lambda tool_call: run_tool_call(tool_call, config)
+
+    for tool_call in tool_calls:
+        if tool_call["name"] in write_tools:
+            results += tool_pool.map(run, batch)
+            batch = []
+            results.append(run(tool_call))
+        else:
+            batch.append(tool_call)
+
+    results += tool_pool.map(run, batch)
+
+    return results
+
+def anime_wrapper(state: State, config: RunnableConfig) -> dict:
     return {
-        "expert": results["messages"]
+        "expert": run_tool_calls(state["expert"][-1].tool_calls, config)
     }
 
 def token_wrapper(state: State) -> dict:
@@ -177,25 +215,26 @@ builder.add_edge("Summarize", END)
 
 graph = builder.compile()
 
-query = input("Query: ")
-
-for event in graph.stream({
-    "messages": [{
-        "role": "user",
-        "content": query
-        }]
-}):
-
-    for node, value in event.items():
-        last_message = None
-
-        if "messages" in value and value["messages"]:
-            last_message = value["messages"][-1]
-        elif "expert" in value and value["expert"]:
-            last_message = value["expert"][-1]
-
-        if last_message:
-            role = getattr(last_message, "role", "Tool").title()
-            content = last_message.content if last_message.content is not None else ""
-            if node != "Update":
-                print(f"{node}: {content}")
+if __name__ == "__main__":
+    query = input("Query: ")
+
+    for event in graph.stream({
+        "messages": [{
+            "role": "user",
+            "content": query
+            }]
+    }):
+
+        for node, value in event.items():
+            last_message = None
+
+            if "messages" in value and value["messages"]:
+                last_message = value["messages"][-1]
+            elif "expert" in value and value["expert"]:
+                last_message = value["expert"][-1]
+
+            if last_message:
+                role = getattr(last_message, "role", "Tool").title()
+                content = last_message.content if last_message.content is not None else ""
+                if node != "Update":
+                    print(f"{node}: {content}")
@@ -0,0 +1,145 @@
+import gc
+import threading
+import importlib.util
+from collections import OrderedDict
+from langchain_huggingface import HuggingFacePipeline
+
+# One lock per model id, so a resident model only ever runs one generation at a time.
+generation_locks = {}
+
+def generation_lock(model_id):
+    return generation_locks.setdefault(model_id, threading.Lock())
+
+class SerializedPipeline(HuggingFacePipeline):
+    '''
+    HuggingFacePipeline that serializes generation calls to the shared model weights.
+    '''
+
+    def _generate(self, *args, **kwargs):
+        with generation_lock(self.model_id):
+            return super()._generate(*args, **kwargs)
+
+    def _stream(self, *args, **kwargs):
+        with generation_lock(self.model_id):
+            yield from super()._stream(*args, **kwargs)
+
+def quantization_available():
+    '''
+    4-bit quantization needs both bitsandbytes and a CUDA device.
+    '''
+    try:
+        import torch
+        return importlib.util.find_spec("bitsandbytes") is not None and torch.cuda.is_available()
+    except Exception:
+        return False
+
+def load_pipeline(model_id):
+    if quantization_available():
+        from transformers import BitsAndBytesConfig
+
+        quant_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4"
+        )
+        return SerializedPipeline.from_model_id(
+            model_id=model_id,
+            task="text-generation",
+            model_kwargs={
+                "quantization_config": quant_config
+            }
+        )
+
+    print(f"bitsandbytes quantization is not available, loading {model_id} on CPU without quantization")
+    return SerializedPipeline.from_model_id(
+        model_id=model_id,
+        task="text-generation",
+        device=-1
+    )
+
+def memory_footprint(llm):
+    try:
+        return llm.pipeline.model.get_memory_footprint()
+    except Exception:
+        return 0
+
+def free_memory():
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
+
+class ModelResidency:
+    '''
+    Keeps local HuggingFace models loaded between queries.
+    At most max_models are resident, and their combined footprint stays under memory_budget bytes when one is given. The least recently used model is unloaded first.
+    on_evict is called with the model id so holders of the model can drop their references.
+    Loading only holds that model's load lock, so a slow load never blocks queries for models that are already resident.
+    '''
+
+    def __init__(self, max_models=1, memory_budget=None, on_evict=None):
+        self.max_models = max_models
+        self.memory_budget = memory_budget
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        self.models = OrderedDict()
+
+    def _resident(self, model_id):
+        if model_id in self.models:
+            self.models.move_to_end(model_id)
+            return self.models[model_id][0]
+        return None
+
+    def get(self, model_id):
+        with self.lock:
+            llm = self._resident(model_id)
+            if llm is not None:
+                return llm
+            load_lock = self.load_locks.setdefault(model_id, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                # Another caller may have loaded it while this one waited.
+                llm = self._resident(model_id)
+                if llm is not None:
+                    return llm
+
+                # Make room before loading so the old weights are released first.
+                self._evict(self.max_models - 1)
+
+            llm = load_pipeline(model_id)
+            footprint = memory_footprint(llm)
+
+            with self.lock:
+                self.models[model_id] = (llm, footprint)
+                self._evict(self.max_models)
+
+        return llm
+
+    def _evict(self, max_models):
+        evicted = False
+
+        while self.models and (len(self.models) > max_models or self._over_budget()):
+            # A single model over budget is kept, otherwise nothing could ever load.
+            if len(self.models) == 1 and max_models >= 1:
+                break
+
+            model_id, _ = self.models.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(model_id)
+            evicted = True
+
+        if evicted:
+            free_memory()
+
+    def _over_budget(self):
+        if self.memory_budget is None:
+            return False
+        return sum(footprint for llm, footprint in self.models.values()) > self.memory_budget
+
+    def resident(self):
+        with self.lock:
+            return list(self.models)
@@ -1,9 +1,13 @@
 import os
+import time
 import google.auth
 from dotenv import load_dotenv
 import gradio as gr
+from starlette.middleware import Middleware
 from brain import MALAI
-from models import groq_models, ollama_models, gemini_models, vertex_models, vertex_anthropic_models, vertex_llama_models, vertex_mistral_models, vertex_gemma_models, azure_openai_models, azure_models, aws_models, openai_models, anthropic_models, mistral_models
+from metrics import metrics, queue_wait_seconds, ArrivalTime
+from pools import pools, PoolFull
+from models import catalogue, vertex_models, vertex_anthropic_models, vertex_llama_models, vertex_mistral_models, vertex_gemma_models
 
 load_dotenv()
 
@@ -51,39 +55,37 @@ if os.getenv("HUGGINGFACEHUB_API_TOKEN"):
 
 providers.sort()
 
+# Fetch every configured provider's models now, so the dropdown is served from memory.
+catalogue.start(providers)
+
+async def answer(query, provider, model, hf_model, request: gr.Request):
+   # ArrivalTime stamps the request that put the query in the queue.
+   arrived_at = getattr(request.request, "scope", {}).get("arrived_at") if request is not None else None
+   if arrived_at is not None:
+      queue_wait_seconds.observe(time.perf_counter() - arrived_at)
+
+   # Gradio's queue caps queries overall, the provider's pool caps them per provider.
+   pool = pools.pool(provider)
+   if pool.full():
+      raise gr.Error(f"{provider} is busy, {pool.waiting} queries are already waiting. Please try again shortly.")
+   if pool.busy():
+      eta = pool.eta(pool.waiting)
+      yield f"Waiting for a free {provider} slot, {pool.waiting} queries ahead of you" + (f", about {round(eta)}s." if eta is not None else ".")
+
+   try:
+      async with pool.slot():
+         async for output in MALAI(query, provider, model, hf_model):
+            yield output
+   except PoolFull as e:
+      raise gr.Error(f"{provider} is busy, {e}. Please try again shortly.")
+
+concurrency_limit = int(os.getenv("MALAI_CONCURRENCY", 16))
+
 def update_models(provider):
-   if provider == "Groq":
-      return gr.Dropdown(choices=groq_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Ollama":
-      return gr.Dropdown(choices=ollama_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Gemini":
-      return gr.Dropdown(choices=gemini_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Vertex":
-      return gr.Dropdown(choices=vertex_models, value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Vertex Anthropic":
-      return gr.Dropdown(choices=vertex_anthropic_models, value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Vertex Llama":
-      return gr.Dropdown(choices=vertex_llama_models, value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Vertex Mistral":
-      return gr.Dropdown(choices=vertex_mistral_models, value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Vertex Gemma":
-      return gr.Dropdown(choices=vertex_gemma_models, value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Azure OpenAI":
-      return gr.Dropdown(choices=azure_openai_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Azure":
-      return gr.Dropdown(choices=azure_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "AWS":
-      return gr.Dropdown(choices=aws_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "OpenAI":
-      return gr.Dropdown(choices=openai_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Anthropic":
-      return gr.Dropdown(choices=anthropic_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "Mistral":
-      return gr.Dropdown(choices=mistral_models(), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
-   elif provider == "HuggingFace Endpoints":
-      return gr.Dropdown([], value=None, interactive=False, visible=False), gr.Textbox(label="Model", visible=True, interactive=True)
-   elif provider == "HuggingFace Local":
+   if provider in ("HuggingFace Endpoints", "HuggingFace Local"):
       return gr.Dropdown([], value=None, interactive=False, visible=False), gr.Textbox(label="Model", visible=True, interactive=True)
+   else:
+      return gr.Dropdown(choices=catalogue.get(provider), value=None, interactive=True, visible=True), gr.Textbox(label="Model", visible=False)
 
 with gr.Blocks(theme=gr.themes.Base()) as demo:
    with gr.Row():
@@ -94,14 +96,34 @@ with gr.Blocks(theme=gr.themes.Base()) as demo:
    output = gr.Textbox(label="Output")
    send = gr.Button("Send")
 
+   # Served from the model catalogue, so it skips the queue rather than waiting behind agent runs.
    provider.change(
       fn=update_models,
       inputs=provider,
-      outputs=[model, hf_model]
+      outputs=[model, hf_model],
+      queue=False
    )
 
-   send.click(fn=MALAI, inputs=[query, provider, model, hf_model], outputs=output, api_name="send")
-   query.submit(fn=MALAI, inputs=[query, provider, model, hf_model], outputs=output, api_name="send")
+   # Both triggers share one concurrency limit.
+   send.click(fn=answer, inputs=[query, provider, model, hf_model], outputs=output, api_name="send", concurrency_limit=concurrency_limit, concurrency_id="query")
+   query.submit(fn=answer, inputs=[query, provider, model, hf_model], outputs=output, api_name="send", concurrency_limit=concurrency_limit, concurrency_id="query")
+
+queue_size = os.getenv("MALAI_QUEUE_SIZE", "64")
+update_rate = os.getenv("MALAI_QUEUE_UPDATE_RATE", "auto")
+
+# A full queue turns new queries away straight away instead of letting them wait.
+demo.queue(
+   max_size=int(queue_size) if queue_size else None,
+   default_concurrency_limit=concurrency_limit,
+   status_update_rate=update_rate if update_rate == "auto" else float(update_rate)
+)
 
 if __name__ == "__main__":
-   demo.launch(share=True)
+   metrics_port = os.getenv("MALAI_METRICS_PORT", "9464")
+   if metrics_port:
+      try:
+         metrics.serve(int(metrics_port), host=os.getenv("MALAI_METRICS_HOST", "127.0.0.1"))
+      except OSError as e:
+         print(f"Could not serve metrics on port {metrics_port}: {e}")
+
+   demo.launch(share=True, max_threads=int(os.getenv("MALAI_MAX_THREADS", 40)), app_kwargs={"middleware": [Middleware(ArrivalTime)]})
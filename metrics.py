@@ -0,0 +1,186 @@
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ITERATION_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    '''
+    Monotonic count per label combination.
+    '''
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in values.items():
+            yield self.name, format_labels(self.labels, key), value
+
+class Histogram:
+    '''
+    Distribution of observed values per label combination, in cumulative buckets as Prometheus expects.
+    observe is a lock, a bisect and two additions, so it can sit on the hot path.
+    '''
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", format_labels(self.labels, key, [("le", bound)]), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, key), total
+            yield f"{self.name}_count", format_labels(self.labels, key), cumulative
+
+class Collected:
+    '''
+    Values read only when scraped, for numbers something else already keeps, e.g. the response caches' hit counts.
+    read returns {label values tuple: value}.
+    '''
+
+    def __init__(self, name, help, labels, read, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.read = read
+        self.kind = kind
+
+    def samples(self):
+        for key, value in self.read().items():
+            yield self.name, format_labels(self.labels, key), value
+
+class Metrics:
+    '''
+    Set of metrics rendered together in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def collected(self, name, help, labels, read, kind="gauge"):
+        return self.add(Collected(name, help, labels, read, kind))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines += [f"{name}{labels} {value}" for name, labels, value in metric.samples()]
+            except Exception as e:
+                print(f"Could not collect {metric.name}: {e}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        '''
+        Serves /metrics from a background thread, separately from the app so scrapes never wait behind it.
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+        return server
+
+class ArrivalTime:
+    '''
+    ASGI middleware that notes when each request reached the server, so a queued event can tell how long it waited.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        scope["arrived_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+metrics = Metrics()
+
+llm_call_seconds = metrics.histogram("malai_llm_call_seconds", "Time for one model call, from request to the last token.", ["provider", "model"])
+llm_first_token_seconds = metrics.histogram("malai_llm_first_token_seconds", "Time from a model call to its first streamed token.", ["provider", "model"])
+query_seconds = metrics.histogram("malai_query_seconds", "Time to answer one query, end to end.", ["provider", "model"])
+agent_iterations = metrics.histogram("malai_agent_iterations", "Model calls the agent made to answer one query.", ["provider", "model"], buckets=ITERATION_BUCKETS)
+mal_request_seconds = metrics.histogram("malai_mal_request_seconds", "Time for one MyAnimeList HTTP request, per attempt.", ["method", "endpoint", "status"])
+token_refreshes = metrics.counter("malai_token_refreshes_total", "MyAnimeList access token refreshes.", ["result"])
+queue_wait_seconds = metrics.histogram("malai_queue_wait_seconds", "Time a query waited in the Gradio queue before it started.")
+provider_wait_seconds = metrics.histogram("malai_provider_wait_seconds", "Time a query waited for a free slot in its provider's pool.", ["provider"])
@@ -0,0 +1,241 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+from client import client, next_page, MAL_API_URL
+from singleflight import SingleFlight
+
+MIRROR_FIELDS = {
+    "anime": "list_status,genres,media_type,num_episodes,mean,start_date",
+    "manga": "list_status,genres,media_type,num_chapters,mean,start_date"
+}
+
+# MAL's list sort names, mapped onto the mirror's columns.
+SORTS = {
+    "list_score": "score DESC, updated_at DESC",
+    "list_updated_at": "updated_at DESC",
+    "anime_title": "title COLLATE NOCASE",
+    "manga_title": "title COLLATE NOCASE",
+    "anime_start_date": "start_date DESC",
+    "manga_start_date": "start_date DESC"
+}
+
+LIST_STATUS_URL = re.compile(re.escape(MAL_API_URL) + r"/(anime|manga)/(\d+)/my_list_status$")
+
+class ListMirror:
+    '''
+    SQLite copy of @me's anime and manga lists, so list questions are answered locally instead of paging through the API.
+    Syncs incrementally by walking the list newest first (list_updated_at) until it reaches entries it has already seen, and does a full sync every full_sync_interval seconds to notice entries removed elsewhere.
+    Writes made through the client are applied immediately.
+    '''
+
+    def __init__(self, path, client, max_age=300, full_sync_interval=86400):
+        self.client = client
+        self.max_age = max_age
+        self.full_sync_interval = full_sync_interval
+        self.flights = SingleFlight()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                kind TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                title TEXT,
+                media_type TEXT,
+                start_date TEXT,
+                status TEXT,
+                score INTEGER,
+                updated_at TEXT,
+                item TEXT NOT NULL,
+                PRIMARY KEY (kind, id)
+            );
+            CREATE INDEX IF NOT EXISTS entries_status ON entries (kind, status);
+            CREATE INDEX IF NOT EXISTS entries_score ON entries (kind, score);
+            CREATE INDEX IF NOT EXISTS entries_updated_at ON entries (kind, updated_at);
+            CREATE TABLE IF NOT EXISTS genres (
+                kind TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                genre TEXT NOT NULL,
+                PRIMARY KEY (kind, id, genre)
+            );
+            CREATE INDEX IF NOT EXISTS genres_genre ON genres (kind, genre);
+            CREATE TABLE IF NOT EXISTS syncs (
+                kind TEXT PRIMARY KEY,
+                watermark TEXT,
+                synced_at REAL NOT NULL,
+                full_synced_at REAL NOT NULL
+            );
+        """)
+        self.db.commit()
+
+    def _save(self, kind, item):
+        node = item["node"]
+        list_status = item.get("list_status") or {}
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                kind, node["id"], node.get("title"), node.get("media_type"), node.get("start_date"),
+                list_status.get("status"), list_status.get("score"), list_status.get("updated_at"),
+                json.dumps(item)
+            )
+        )
+        self.db.execute("DELETE FROM genres WHERE kind = ? AND id = ?", (kind, node["id"]))
+        self.db.executemany(
+            "INSERT OR IGNORE INTO genres VALUES (?, ?, ?)",
+            [(kind, node["id"], genre["name"].lower()) for genre in node.get("genres", [])]
+        )
+
+    def _sync_state(self, kind):
+        with self.lock:
+            return self.db.execute("SELECT watermark, synced_at, full_synced_at FROM syncs WHERE kind = ?", (kind,)).fetchone()
+
+    def _pages(self, kind, limit, sort=None):
+        url = f"{MAL_API_URL}/users/@me/{kind}list"
+        params = {"fields": MIRROR_FIELDS[kind], "limit": limit, "sort": sort, "nsfw": "true"}
+
+        while url:
+            page = self.client.get(url, params)
+            if "error" in page:
+                raise RuntimeError(page["error"])
+
+            yield page
+            url, params = next_page(page), None
+
+    def full_sync(self, kind):
+        items = [item for page in self._pages(kind, 1000) for item in page.get("data", [])]
+        watermark = max((item.get("list_status", {}).get("updated_at") or "" for item in items), default="")
+        now = time.time()
+
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM entries WHERE kind = ?", (kind,))
+                self.db.execute("DELETE FROM genres WHERE kind = ?", (kind,))
+                for item in items:
+                    self._save(kind, item)
+                self.db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?)", (kind, watermark, now, now))
+
+        return len(items)
+
+    def incremental_sync(self, kind, watermark):
+        '''
+        Fetches entries updated after watermark. Pages are requested one at a time, since the walk usually stops on the first page.
+        '''
+        items = []
+
+        for page in self._pages(kind, 100, sort="list_updated_at"):
+            newer = [item for item in page.get("data", []) if (item.get("list_status", {}).get("updated_at") or "") > watermark]
+            items += newer
+            if len(newer) < len(page.get("data", [])):
+                break
+
+        watermark = max([watermark] + [item["list_status"]["updated_at"] for item in items])
+
+        with self.lock:
+            with self.db:
+                for item in items:
+                    self._save(kind, item)
+                self.db.execute("UPDATE syncs SET watermark = ?, synced_at = ? WHERE kind = ?", (watermark, time.time(), kind))
+
+        return len(items)
+
+    def sync(self, kind, force=False):
+        state = self._sync_state(kind)
+        now = time.time()
+
+        if state is None or now - state[2] > self.full_sync_interval:
+            return self.full_sync(kind)
+        if force or now - state[1] > self.max_age:
+            return self.incremental_sync(kind, state[0] or "")
+        return 0
+
+    def refresh(self, kind):
+        '''
+        Syncs if the mirror is older than max_age. Concurrent callers share one sync, and a failed sync falls back to the last synced copy.
+        '''
+        try:
+            self.flights.do(("sync", kind), lambda: self.sync(kind))
+        except Exception as e:
+            if self._sync_state(kind) is None:
+                raise
+            print(f"Serving the last synced {kind} list: {e}")
+
+    def query(self, kind, status=None, genre=None, media_type=None, sort="list_score", limit=None, offset=0):
+        '''
+        Returns entries in MAL's list format, {"data": [{"node": ..., "list_status": ...}], "total": n}.
+        If the list has never synced and can't be now, returns {"error": ...} like a failed API call, so the model sees it instead of the run failing.
+        '''
+        try:
+            self.refresh(kind)
+        except Exception as e:
+            return {"error": f"Could not sync {kind} list: {e}"}
+
+        where = ["entries.kind = ?"]
+        args = [kind]
+
+        if status:
+            where.append("entries.status = ?")
+            args.append(status)
+        if media_type:
+            where.append("entries.media_type = ?")
+            args.append(media_type)
+        if genre:
+            where.append("entries.id IN (SELECT id FROM genres WHERE kind = ? AND genre = ?)")
+            args += [kind, genre.lower()]
+
+        condition = " AND ".join(where)
+        order = SORTS.get(sort, SORTS["list_score"])
+
+        with self.lock:
+            total = self.db.execute(f"SELECT COUNT(*) FROM entries WHERE {condition}", args).fetchone()[0]
+            rows = self.db.execute(
+                f"SELECT item FROM entries WHERE {condition} ORDER BY {order} LIMIT ? OFFSET ?",
+                args + [-1 if limit is None else int(limit), int(offset or 0)]
+            ).fetchall()
+
+        return {
+            "data": [json.loads(row[0]) for row in rows],
+            "total": total
+        }
+
+    def write_through(self, method, url, data, result):
+        '''
+        client.on_write listener. Applies list status updates and deletions made through the API.
+        '''
+        match = LIST_STATUS_URL.search(url)
+        if match is None or (isinstance(result, dict) and "error" in result):
+            return
+
+        kind, id = match.group(1), int(match.group(2))
+
+        with self.lock:
+            with self.db:
+                if method == "DELETE":
+                    self.db.execute("DELETE FROM entries WHERE kind = ? AND id = ?", (kind, id))
+                    self.db.execute("DELETE FROM genres WHERE kind = ? AND id = ?", (kind, id))
+                    return
+
+                row = self.db.execute("SELECT item FROM entries WHERE kind = ? AND id = ?", (kind, id)).fetchone()
+
+                # Entries new to the list only have their status until the next sync fills in the rest,
+                # which picks them up because their updated_at is newer than the watermark.
+                if row is None:
+                    self.db.execute("UPDATE syncs SET synced_at = 0 WHERE kind = ?", (kind,))
+
+                item = json.loads(row[0]) if row else {"node": {"id": id}}
+                item["list_status"] = {**item.get("list_status", {}), **result}
+                self._save(kind, item)
+
+mirror = None
+if os.getenv("MAL_MIRROR_DB"):
+    mirror = ListMirror(
+        os.getenv("MAL_MIRROR_DB"),
+        client,
+        max_age=float(os.getenv("MAL_MIRROR_MAX_AGE", 300)),
+        full_sync_interval=float(os.getenv("MAL_MIRROR_FULL_SYNC", 86400))
+    )
+    client.on_write.append(mirror.write_through)
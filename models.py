@@ -1,10 +1,21 @@
 import os
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from dotenv import load_dotenv
 import requests
 from azure.identity import DefaultAzureCredential
 from azure.mgmt.cognitiveservices import CognitiveServicesManagementClient
 import boto3
+from botocore.config import Config
+
+load_dotenv()
+
+# Per-call timeout for every provider's model listing, so one slow provider can't hang the dropdown.
+REQUEST_TIMEOUT = float(os.getenv("MODEL_LIST_TIMEOUT", 10))
+
+session = requests.Session()
 
 def groq_models():
     load_dotenv()
@@ -13,7 +24,7 @@ def groq_models():
         "Authorization": f"Bearer {os.getenv("GROQ_API_KEY")}"
     }
 
-    response = requests.get("https://api.groq.com/openai/v1/models", headers=headers).json()
+    response = session.get("https://api.groq.com/openai/v1/models", headers=headers, timeout=REQUEST_TIMEOUT).json()
 
     models = []
 
@@ -27,7 +38,7 @@ def groq_models():
 def ollama_models():
     load_dotenv()
 
-    response = requests.get(f"{os.getenv("OLLAMA_HOST")}/api/tags").json()
+    response = session.get(f"{os.getenv("OLLAMA_HOST")}/api/tags", timeout=REQUEST_TIMEOUT).json()
 
     models = []
 
@@ -46,7 +57,7 @@ def gemini_models():
         "x-goog-api-key": os.getenv("GEMINI_API_KEY")
     }
 
-    response = requests.get("https://generativelanguage.googleapis.com/v1beta/models", headers=headers).json()
+    response = session.get("https://generativelanguage.googleapis.com/v1beta/models", headers=headers, timeout=REQUEST_TIMEOUT).json()
 
     models = []
 
@@ -84,7 +95,9 @@ def azure_openai_models():
 
     deployments = client.deployments.list(
         resource_group_name=os.getenv("AZURE_RESOURCE_GROUP_NAME"),
-        account_name = os.getenv("AZURE_OPENAI_ACCOUNT_NAME")
+        account_name = os.getenv("AZURE_OPENAI_ACCOUNT_NAME"),
+        connection_timeout=REQUEST_TIMEOUT,
+        read_timeout=REQUEST_TIMEOUT
     )
 
     models = []
@@ -106,7 +119,9 @@ def azure_models():
 
     catalogue = client.accounts.list_models(
         resource_group_name=os.getenv("AZURE_RESOURCE_GROUP_NAME"),
-        account_name = os.getenv("AZURE_FOUNDRY_PROJECT_NAME")
+        account_name = os.getenv("AZURE_FOUNDRY_PROJECT_NAME"),
+        connection_timeout=REQUEST_TIMEOUT,
+        read_timeout=REQUEST_TIMEOUT
     )
 
     models = []
@@ -126,7 +141,11 @@ def aws_models():
     AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
     AWS_REGION = os.getenv("AWS_REGION")
 
-    bedrock_client = boto3.client("bedrock", region_name=AWS_REGION)
+    bedrock_client = boto3.client(
+        "bedrock",
+        region_name=AWS_REGION,
+        config=Config(connect_timeout=REQUEST_TIMEOUT, read_timeout=REQUEST_TIMEOUT, retries={"max_attempts": 2})
+    )
     response = bedrock_client.list_foundation_models()
     model_summaries = response.get("modelSummaries", [])
 
@@ -157,7 +176,7 @@ def openai_models():
         "Authorization": f"Bearer {os.getenv("OPENAI_API_KEY")}"
     }
 
-    response = requests.get(api_uri, headers=headers).json()
+    response = session.get(api_uri, headers=headers, timeout=REQUEST_TIMEOUT).json()
 
     models = []
 
@@ -178,7 +197,7 @@ def anthropic_models():
         "x-api-key": os.getenv("ANTHROPIC_API_KEY")
     }
 
-    response = requests.get(api_uri, headers=headers).json()
+    response = session.get(api_uri, headers=headers, timeout=REQUEST_TIMEOUT).json()
 
     models = []
 
@@ -198,7 +217,7 @@ def mistral_models():
         "Authorization": f"Bearer {os.getenv("MISTRAL_API_KEY")}"
     }
 
-    response = requests.get(api_uri, headers=headers).json()
+    response = session.get(api_uri, headers=headers, timeout=REQUEST_TIMEOUT).json()
 
     models = []
 
@@ -208,4 +227,90 @@ def mistral_models():
 
     models.sort()
 
-    return models
\ No newline at end of file
+    return models
+
+class ModelCatalogue:
+    '''
+    Keeps every provider's model list in memory so the dropdown never waits on a provider API.
+    Lists are fetched concurrently in the background. Once older than ttl seconds the cached list is still served while a refresh runs, and a provider that fails keeps its last good list, or an empty one if it never listed.
+    '''
+
+    def __init__(self, sources, ttl=3600, timeout=15):
+        self.sources = sources
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.models = {}
+        self.pending = {}
+        self.pool = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="model-catalogue")
+
+    def fetch(self, provider):
+        try:
+            models = self.sources[provider]()
+            with self.lock:
+                self.models[provider] = (time.monotonic(), models)
+            return models
+        except Exception as e:
+            print(f"Could not list {provider} models: {e}")
+            with self.lock:
+                # A provider that has never listed gets an empty list, so it is served from memory and retried after ttl instead of on every request.
+                return self.models.setdefault(provider, (time.monotonic(), []))[1]
+        finally:
+            with self.lock:
+                self.pending.pop(provider, None)
+
+    def refresh(self, provider):
+        '''
+        Starts a background fetch of one provider's models, unless one is already running.
+        '''
+        with self.lock:
+            future = self.pending.get(provider)
+            if future is None:
+                future = self.pool.submit(self.fetch, provider)
+                self.pending[provider] = future
+            return future
+
+    def start(self, providers):
+        for provider in providers:
+            if provider in self.sources:
+                self.refresh(provider)
+
+    def get(self, provider):
+        if provider not in self.sources:
+            return []
+
+        with self.lock:
+            entry = self.models.get(provider)
+
+        # Only the very first request for a provider waits, and at most timeout seconds.
+        if entry is None:
+            try:
+                return self.refresh(provider).result(timeout=self.timeout)
+            except TimeoutError:
+                return []
+
+        if time.monotonic() - entry[0] > self.ttl:
+            self.refresh(provider)
+
+        return entry[1]
+
+catalogue = ModelCatalogue(
+    {
+        "Groq": groq_models,
+        "Ollama": ollama_models,
+        "Gemini": gemini_models,
+        "Vertex": lambda: vertex_models,
+        "Vertex Anthropic": lambda: vertex_anthropic_models,
+        "Vertex Llama": lambda: vertex_llama_models,
+        "Vertex Mistral": lambda: vertex_mistral_models,
+        "Vertex Gemma": lambda: vertex_gemma_models,
+        "Azure OpenAI": azure_openai_models,
+        "Azure": azure_models,
+        "AWS": aws_models,
+        "OpenAI": openai_models,
+        "Anthropic": anthropic_models,
+        "Mistral": mistral_models
+    },
+    ttl=float(os.getenv("MODEL_LIST_TTL", 3600)),
+    timeout=REQUEST_TIMEOUT + 5
+)
@@ -0,0 +1,100 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from metrics import provider_wait_seconds
+
+class PoolFull(RuntimeError):
+    '''
+    Raised when a provider already has max_waiting queries waiting for a slot.
+    '''
+
+class Pool:
+    '''
+    Caps how many queries run at once against one provider. Waiting queries are let in first come, first served.
+    Keeps a moving average of how long a query holds its slot, to estimate waits.
+    '''
+
+    def __init__(self, name, size, max_waiting=None):
+        self.name = name
+        self.size = size
+        self.max_waiting = max_waiting
+        self.semaphore = asyncio.Semaphore(size)
+        self.waiting = 0
+        self.running = 0
+        self.average = None
+
+    def busy(self):
+        return self.semaphore.locked()
+
+    def full(self):
+        return self.max_waiting is not None and self.busy() and self.waiting >= self.max_waiting
+
+    def eta(self, ahead):
+        '''
+        Rough seconds until a query with ahead queries in front of it gets a slot, or None before any query has finished.
+        '''
+        if self.average is None:
+            return None
+        return (ahead // self.size + 1) * self.average
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.full():
+            raise PoolFull(f"{self.waiting} queries are already waiting")
+
+        self.waiting += 1
+        queued = time.monotonic()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        provider_wait_seconds.observe(time.monotonic() - queued, provider=self.name)
+
+        self.running += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+            elapsed = time.monotonic() - started
+            self.average = elapsed if self.average is None else 0.8 * self.average + 0.2 * elapsed
+
+class ProviderPools:
+    '''
+    One Pool per provider, e.g. a single slot for local HuggingFace models and several for hosted APIs.
+    limits maps provider names to their size, every other provider gets default.
+    '''
+
+    def __init__(self, limits=None, default=8, max_waiting=None):
+        self.limits = limits or {}
+        self.default = default
+        self.max_waiting = max_waiting
+        self.pools = {}
+
+    def pool(self, provider):
+        pool = self.pools.get(provider)
+        if pool is None:
+            pool = self.pools[provider] = Pool(provider, self.limits.get(provider, self.default), self.max_waiting)
+        return pool
+
+def parse_limits(value):
+    '''
+    Parses "HuggingFace Local=1,Ollama=2" into {"HuggingFace Local": 1, "Ollama": 2}.
+    '''
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            provider, size = item.rsplit("=", 1)
+            limits[provider.strip()] = int(size)
+    return limits
+
+max_waiting = os.getenv("MALAI_PROVIDER_QUEUE_SIZE", "32")
+
+pools = ProviderPools(
+    limits=parse_limits(os.getenv("MALAI_PROVIDER_CONCURRENCY", "HuggingFace Local=1")),
+    default=int(os.getenv("MALAI_PROVIDER_DEFAULT_CONCURRENCY", 8)),
+    max_waiting=int(max_waiting) if max_waiting else None
+)
@@ -0,0 +1,36 @@
+import os
+from langchain_core.prompts import PromptTemplate
+
+# Local copy of hwchase17/react from LangChain Hub, so the agent works offline.
+REACT_TEMPLATE = """Answer the following questions as best you can. You have access to the following tools:
+
+{tools}
+
+Use the following format:
+
+Question: the input question you must answer
+Thought: you should always think about what to do
+Action: the action to take, should be one of [{tool_names}]
+Action Input: the input to the action
+Observation: the result of the action
+... (this Thought/Action/Action Input/Observation can repeat N times)
+Thought: I now know the final answer
+Final Answer: the final answer to the original input question
+
+Begin!
+
+Question: {input}
+Thought:{agent_scratchpad}"""
+
+def load_react_prompt():
+    '''
+    Returns the ReAct prompt. Uses the bundled copy unless REACT_PROMPT_HUB is true, in which case the latest version is pulled from LangChain Hub, falling back to the bundled copy if the hub is unreachable.
+    '''
+    if os.getenv("REACT_PROMPT_HUB", "false").lower() == "true":
+        try:
+            from langchain import hub
+            return hub.pull("hwchase17/react")
+        except Exception as e:
+            print(f"Could not pull hwchase17/react from LangChain Hub, using the bundled prompt: {e}")
+
+    return PromptTemplate.from_template(REACT_TEMPLATE)
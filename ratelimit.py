@@ -0,0 +1,101 @@
+import time
+import asyncio
+import sqlite3
+import threading
+
+class TokenBucket:
+    '''
+    Process-wide token bucket. Allows bursts of up to burst requests and refills at rate requests per second.
+    reserve takes a token and returns how long the caller has to wait before using it, so blocking and async callers share one bucket.
+    '''
+
+    def __init__(self, rate=2.0, burst=5):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def _take(self, tokens, updated, now):
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        return tokens, max(0.0, -tokens / self.rate)
+
+    def reserve(self):
+        with self.lock:
+            now = time.time()
+            self.tokens, wait = self._take(self.tokens, self.updated, now)
+            self.updated = now
+            return wait
+
+    def penalize(self, seconds):
+        '''
+        Empties the bucket so nobody sends for the next seconds, e.g. after a 429 with Retry-After.
+        '''
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.tokens = min(tokens, -seconds * self.rate)
+            self.updated = now
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    async def apenalize(self, seconds):
+        self.penalize(seconds)
+
+class SharedTokenBucket(TokenBucket):
+    '''
+    Token bucket whose state lives in a SQLite file, so several worker processes on one host share a single budget.
+    SQLite's write lock serializes the read-modify-write between processes.
+    '''
+
+    def __init__(self, path, rate=2.0, burst=5, name="mal"):
+        super().__init__(rate=rate, burst=burst)
+        self.name = name
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        self.db.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)", (name, float(burst), time.time()))
+
+    def _update(self, change):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, updated = self.db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (self.name,)).fetchone()
+                now = time.time()
+                tokens, result = change(tokens, updated, now)
+                self.db.execute("UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?", (tokens, now, self.name))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+        return result
+
+    def reserve(self):
+        return self._update(self._take)
+
+    async def aacquire(self):
+        # BEGIN IMMEDIATE can wait up to the connection timeout for other processes, so it runs in a thread.
+        wait = await asyncio.to_thread(self.reserve)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def penalize(self, seconds):
+        def change(tokens, updated, now):
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            return min(tokens, -seconds * self.rate), None
+
+        self._update(change)
+
+    async def apenalize(self, seconds):
+        await asyncio.to_thread(self.penalize, seconds)
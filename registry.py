@@ -0,0 +1,81 @@
+import time
+import threading
+from collections import OrderedDict
+
+class Registry:
+    '''
+    Keyed store of expensive objects such as LLM clients and agent executors.
+    Objects are built on first use by the given factory, evicted least-recently-used past maxsize, and dropped once idle for idle_timeout seconds.
+    Concurrent requests for the same missing key build it only once.
+    '''
+
+    def __init__(self, maxsize=8, idle_timeout=1800, on_evict=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.building = {}
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        entry[1] = time.monotonic()
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def _expired(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        return [key for key, (value, last_used) in self.entries.items() if last_used < cutoff]
+
+    def get(self, key, factory):
+        self._evicted(self.expire())
+        evicted = []
+
+        with self.lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            build_lock = self.building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            with self.lock:
+                value = self._lookup(key)
+            if value is not None:
+                return value
+
+            value = factory()
+
+            with self.lock:
+                self.entries[key] = [value, time.monotonic()]
+                self.building.pop(key, None)
+
+                while len(self.entries) > self.maxsize:
+                    evicted.append(self.entries.popitem(last=False))
+
+        self._evicted(evicted)
+        return value
+
+    def expire(self):
+        with self.lock:
+            return [(key, self.entries.pop(key)) for key in self._expired()]
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self._evicted([(key, entry)])
+
+    def _evicted(self, evicted):
+        if self.on_evict is None:
+            return
+
+        for key, (value, last_used) in evicted:
+            self.on_evict(key, value)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
@@ -0,0 +1,220 @@
+import io
+import copy
+import csv
+import json
+import threading
+from metrics import metrics
+
+# Named groups of fields the model can ask for instead of listing fields one by one.
+FIELD_PRESETS = {
+    "anime": {
+        "summary": "id,title,alternative_titles,start_date,end_date,media_type,status,num_episodes,genres,mean,rank,synopsis",
+        "scoring": "id,title,mean,rank,popularity,num_list_users,num_scoring_users,statistics",
+        "relations": "id,title,related_anime,related_manga,recommendations"
+    },
+    "manga": {
+        "summary": "id,title,alternative_titles,start_date,end_date,media_type,status,num_volumes,num_chapters,authors,genres,mean,rank,synopsis",
+        "scoring": "id,title,mean,rank,popularity,num_list_users,num_scoring_users",
+        "relations": "id,title,related_anime,related_manga,recommendations"
+    }
+}
+
+IMAGE_KEYS = {"main_picture", "pictures", "picture"}
+
+def expand_fields(fields, kind):
+    '''
+    Replaces preset names in a comma separated field list with the fields they stand for.
+    '''
+    expanded = []
+
+    for field in str(fields or "").split(","):
+        field = field.strip()
+        for name in FIELD_PRESETS[kind].get(field, field).split(","):
+            if name and name not in expanded:
+                expanded.append(name)
+
+    return ",".join(expanded)
+
+def is_image_url(value):
+    return isinstance(value, str) and value.startswith("http") and value.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".gif"))
+
+def shape(data):
+    '''
+    Returns a copy of a MAL response without image URLs and redundant nesting.
+    {"node": {...}, "ranking": {"rank": 1}} becomes {..., "rank": 1}, and lists of {"id", "name"} such as genres or studios become lists of names.
+    '''
+    if isinstance(data, list):
+        if data and all(isinstance(item, dict) and set(item) == {"id", "name"} for item in data):
+            return [item["name"] for item in data]
+        return [shape(item) for item in data if not is_image_url(item)]
+
+    if not isinstance(data, dict):
+        return data
+
+    shaped = {}
+
+    if isinstance(data.get("node"), dict):
+        shaped.update(shape(data["node"]))
+
+    for key, value in data.items():
+        if key == "node" and isinstance(value, dict):
+            continue
+        if key in IMAGE_KEYS or is_image_url(value):
+            continue
+        if key == "relation_type" and "relation_type_formatted" in data:
+            continue
+
+        # {"ranking": {"rank": 1}} -> {"rank": 1}
+        if key == "ranking" and isinstance(value, dict):
+            shaped.update(value)
+            continue
+
+        shaped[key] = shape(value)
+
+    return shaped
+
+def largest_list(data, path=()):
+    '''
+    Finds the longest list in data, returned as (length, path to it).
+    '''
+    best = (0, None)
+
+    if isinstance(data, list):
+        best = (len(data), path)
+        items = enumerate(data)
+    elif isinstance(data, dict):
+        items = data.items()
+    else:
+        return best
+
+    for key, value in items:
+        found = largest_list(value, path + (key,))
+        if found[0] > best[0]:
+            best = found
+
+    return best
+
+def flatten(item, prefix=""):
+    '''
+    Flattens nested dicts into dotted keys and lists into "; " separated values, for one table row.
+    '''
+    row = {}
+
+    for key, value in item.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            row.update(flatten(value, name + "."))
+        elif isinstance(value, list):
+            row[name] = "; ".join(json.dumps(part, separators=(",", ":")) if isinstance(part, (dict, list)) else str(part) for part in value)
+        else:
+            row[name] = value
+
+    return row
+
+def table(items):
+    rows = [flatten(item) for item in items]
+
+    columns = []
+    for row in rows:
+        for column in row:
+            if column not in columns:
+                columns.append(column)
+
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(["" if row.get(column) is None else row.get(column) for column in columns])
+
+    return output.getvalue().rstrip("\n")
+
+def compact_dumps(data):
+    '''
+    Token-efficient alternative to json.dumps for tool output.
+    paging links are dropped, list responses become a CSV table with one row per entry, and anything else is JSON without spaces.
+    '''
+    if isinstance(data, dict):
+        data = {key: value for key, value in data.items() if key != "paging"}
+        items = data.get("data")
+
+        if isinstance(items, list) and items and all(isinstance(item, dict) for item in items):
+            text = table(items)
+            rest = {key: value for key, value in data.items() if key != "data"}
+            if rest:
+                text += "\n" + json.dumps(rest, separators=(",", ":"))
+            return text
+
+    return json.dumps(data, separators=(",", ":"))
+
+class Savings:
+    '''
+    Per-tool tally of output size with and without compact encoding. Tokens are estimated at four characters each.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tools = {}
+
+    def record(self, tool_name, verbose_chars, compact_chars):
+        with self.lock:
+            calls, verbose, compact = self.tools.get(tool_name, (0, 0, 0))
+            self.tools[tool_name] = (calls + 1, verbose + verbose_chars, compact + compact_chars)
+
+    def report(self):
+        with self.lock:
+            return {
+                tool_name: {
+                    "calls": calls,
+                    "tokens_before": verbose // 4,
+                    "tokens_after": compact // 4,
+                    "saved_percent": round(100 * (1 - compact / verbose), 1) if verbose else 0.0
+                }
+                for tool_name, (calls, verbose, compact) in self.tools.items()
+            }
+
+savings = Savings()
+
+metrics.collected("malai_tool_output_tokens_total", "Estimated tokens of tool output as JSON and with compact encoding, whichever is sent.", ["tool", "encoding"], lambda: {
+    (tool_name, encoding): tokens
+    for tool_name, report in savings.report().items()
+    for encoding, tokens in (("json", report["tokens_before"]), ("compact", report["tokens_after"]))
+}, kind="counter")
+
+def fit(data, max_chars, dumps=json.dumps):
+    '''
+    Serializes data with dumps within max_chars (about four characters per token).
+    The longest list is trimmed first, with a marker saying how many items were left out. As a last resort the text itself is cut.
+    '''
+    text = dumps(data)
+    if max_chars is None or len(text) <= max_chars:
+        return text
+
+    data = copy.deepcopy(data)
+    truncated = {}
+
+    while len(text) > max_chars:
+        length, path = largest_list(data)
+        if length <= 1:
+            break
+
+        parent = data
+        for key in path[:-1]:
+            parent = parent[key]
+        items = parent[path[-1]] if path else data
+
+        del items[max(1, length // 2):]
+
+        label = ".".join(str(key) for key in path) or "results"
+        truncated[label] = truncated.get(label, 0) + length - len(items)
+
+        marked = {"truncated": {label: f"{count} more items omitted" for label, count in truncated.items()}}
+        if isinstance(data, dict):
+            text = dumps({**data, **marked})
+        else:
+            text = dumps({"data": data, **marked})
+
+    if len(text) > max_chars:
+        omitted = len(text) - max_chars
+        text = text[:max_chars] + f"...[truncated {omitted} characters]"
+
+    return text
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+class SingleFlight:
+    '''
+    Coalesces identical concurrent calls. The first caller for a key runs the call, everyone else arriving while it is in flight waits for and shares its result, or its exception.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.tasks = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+    async def ado(self, key, fn):
+        '''
+        Async version of do. fn is a coroutine function. Tasks belong to an event loop, so calls are only coalesced within one loop.
+        '''
+        key = (asyncio.get_running_loop(), key)
+
+        with self.lock:
+            task = self.tasks.get(key)
+            if task is None:
+                task = asyncio.ensure_future(fn())
+                self.tasks[key] = task
+                task.add_done_callback(lambda done: self._finished(key))
+
+        # Shielded, so one waiter being cancelled doesn't cancel the request for the others.
+        return await asyncio.shield(task)
+
+    def _finished(self, key):
+        with self.lock:
+            self.tasks.pop(key, None)
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls) + len(self.tasks)
@@ -0,0 +1,114 @@
+import os
+import queue
+import atexit
+import random
+import threading
+from langchain_core.callbacks import BaseCallbackHandler
+from metrics import metrics
+
+class QueuedHandler(BaseCallbackHandler):
+    '''
+    Callback handler for one traced query. Events are only put on the tracer's queue, the Langfuse handler runs on the tracer's thread.
+    Once an event is dropped the rest of the query is dropped too, rather than sending events for spans Langfuse never saw start.
+    '''
+
+    # Called directly on the event loop instead of being handed to a thread, putting on the queue is cheap enough.
+    run_inline = True
+
+    def __init__(self, tracer, handler):
+        self.tracer = tracer
+        self.handler = handler
+        self.dropped = False
+
+    def forward(self, name, args, kwargs):
+        if not self.dropped and not self.tracer.submit(self.handler, name, args, kwargs):
+            self.dropped = True
+
+def forwarder(name):
+    return lambda self, *args, **kwargs: self.forward(name, args, kwargs)
+
+for name in [name for name in dir(BaseCallbackHandler) if name.startswith("on_")]:
+    setattr(QueuedHandler, name, forwarder(name))
+
+class Tracer:
+    '''
+    Process-wide Langfuse tracing that stays off the request path.
+    A query is traced with probability sample_rate, untraced queries get no callbacks at all.
+    Traced queries only queue their events. One background thread feeds them to Langfuse, whose client batches and flushes spans on its own thread.
+    The queue holds at most max_queue events, when it is full new traces are dropped rather than slowing the query down.
+    '''
+
+    def __init__(self, enabled=True, sample_rate=1.0, max_queue=10000):
+        self.enabled = enabled and sample_rate > 0
+        self.sample_rate = sample_rate
+        self.events = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.client = None
+
+        if self.enabled:
+            from langfuse import Langfuse
+
+            # Sampling is decided per query here, so Langfuse itself keeps everything it is given.
+            self.client = Langfuse(
+                secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
+                public_key=os.getenv("LANGFUSE_PUBLIC_KEY"),
+                host=os.getenv("LANGFUSE_HOST"),
+                sample_rate=1.0
+            )
+
+            threading.Thread(target=self.work, name="langfuse-events", daemon=True).start()
+            # Registered after the Langfuse client, so it runs before the client's own shutdown.
+            atexit.register(self.flush)
+
+    def callbacks(self):
+        '''
+        Callbacks for one query, empty if tracing is off or the query wasn't sampled.
+        '''
+        if not self.enabled or random.random() >= self.sample_rate:
+            return []
+
+        from langfuse.langchain import CallbackHandler
+
+        # A handler per query, so a dropped trace's open spans go away with it.
+        return [QueuedHandler(self, CallbackHandler())]
+
+    def submit(self, handler, name, args, kwargs):
+        try:
+            self.events.put_nowait((handler, name, args, kwargs))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def work(self):
+        while True:
+            handler, name, args, kwargs = self.events.get()
+            try:
+                getattr(handler, name)(*args, **kwargs)
+            except NotImplementedError:
+                pass
+            except Exception as e:
+                print(f"Langfuse callback {name} failed: {e}")
+            finally:
+                self.events.task_done()
+
+    def flush(self):
+        '''
+        Hands every queued event to Langfuse and sends what it has buffered.
+        '''
+        if self.client is None:
+            return
+
+        self.events.join()
+        self.client.flush()
+
+tracer = Tracer(
+    enabled=bool(os.getenv("LANGFUSE_PUBLIC_KEY") and os.getenv("LANGFUSE_SECRET_KEY")) and os.getenv("MALAI_TRACING", "true").lower() == "true",
+    sample_rate=float(os.getenv("MALAI_TRACE_SAMPLE_RATE", 1)),
+    max_queue=int(os.getenv("MALAI_TRACE_QUEUE_SIZE", 10000))
+)
+
+# A query stops submitting after its first dropped event, so this counts traces cut short.
+metrics.collected("malai_traces_dropped_total", "Traced queries cut short because the Langfuse event queue was full.", [], lambda: {(): tracer.dropped}, kind="counter")